@@ -6,7 +6,7 @@ import uasyncio as asyncio
 import BLE_CEEO
 
 # BLE Central
-camera_ble = BLE_CEEO.Listen(name='Pico', verbose=True)
+camera_ble = BLE_CEEO.AsyncListen(name='Pico', verbose=True)
 
 # Initialize sensor
 sensor.reset()
@@ -53,7 +53,7 @@ async def switch_game_mode():
 async def main():
     global movement_detected
     asyncio.create_task(switch_game_mode())
-    camera_ble.connect_up()
+    await camera_ble.connect_up()
 
     while camera_ble.is_connected:
         clock.tick()
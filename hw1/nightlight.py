@@ -1,7 +1,7 @@
 from machine import Pin, PWM
 import neopixel
 import uasyncio as asyncio
-from mqtt import MQTTClient
+from mqtt_async import AsyncMQTTClient
 import gc
 
 # MQTT Settings
@@ -63,15 +63,14 @@ async def sound_buzzer():
 
 # ---------------------------------MQTT-----------------------------
 async def mqtt_client():
-    client = MQTTClient('ME35_chris', mqtt_broker, 1883)
-    client.set_callback(callback)  
-    client.connect()
+    client = AsyncMQTTClient('ME35_chris', mqtt_broker, 1883)
+    await client.connect()
     print('Connected to MQTT broker')
-    client.subscribe(topic_sub.encode())
+    await client.subscribe(topic_sub.encode())
 
-    while True:
-        client.check_msg()  
-        await asyncio.sleep(0.1) 
+    # Messages are handled as soon as they arrive instead of polling
+    async for topic, msg in client:
+        callback(topic, msg)
 
 async def main():
     gc.collect()
@@ -138,8 +138,9 @@ class TapLight:
     def mqtt_connect(self):
         self.client = MQTTClient('TapLight_Client', self.MQTT_BROKER, self.MQTT_PORT, keepalive=60)
         self.client.set_callback(self.callback)
+        self.client.set_reconnect()  # resume the session instead of dropping publishes
         self.client.connect()
-        self.client.subscribe(self.TOPIC_SUB)
+        self.client.subscribe(self.TOPIC_SUB, qos=2)  # start/stop applied exactly once
         print(f"Connected to MQTT broker at {self.MQTT_BROKER}, subscribed to topic '{self.TOPIC_SUB}'")
         self.np[0] = self.colors[2]
         self.np.write()
@@ -208,15 +209,11 @@ class TapLight:
     Function Contract:
     - Inputs: None
     - Outputs: Continuously monitors MQTT messages.
-    - Side effects: Reconnects to MQTT if a connection error occurs.
+    - Side effects: The client reconnects by itself (see set_reconnect()), keeping its offline queue.
     """
     async def check_mqtt(self):
         while True:
-            try:
-                self.client.check_msg()
-            except OSError as e:
-                print("MQTT Error")
-                self.mqtt_connect()
+            self.client.check_msg()
             await asyncio.sleep(0.1)
 
     """
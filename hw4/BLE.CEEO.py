@@ -1,7 +1,13 @@
 import bluetooth
+import errno
 import time
 import struct
+import machine
 import micropython
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
 micropython.alloc_emergency_exception_buf(128)
  
 NAME_FLAG = 0x09
@@ -31,6 +37,20 @@ IRQ_GATTC_READ_DONE = 16
 IRQ_GATTC_WRITE_DONE = 17
 IRQ_GATTC_NOTIFY = 18
 IRQ_GATTC_INDICATE = 19
+IRQ_MTU_EXCHANGED = 21
+
+# Messages longer than one packet go out as fragments, each starting with
+# FRAG, a message sequence number and the fragment index (bit 7 set on the
+# last one). 0xFE never occurs in UTF-8 text, so short text messages are
+# sent as they are; anything else starting with it is sent as a fragment.
+FRAG = 0xFE
+ATT_MTU = 23  # until an exchange agrees on more
+
+# Wake-ups for the async classes, indexing Useful._flags.
+WAKE_CONN = 0
+WAKE_SCAN = 1
+WAKE_RX = 2
+WAKE_TX = 3
 
 UART_SERVICE_UUID = bluetooth.UUID("6E400001-B5A3-F393-E0A9-E50E24DCCA9E")
 UART_RX_CHAR_UUID = bluetooth.UUID("6E400002-B5A3-F393-E0A9-E50E24DCCA9E")
@@ -54,15 +74,62 @@ MIDI_TXRX = (MIDI_CHAR_UUID, FLAG_READ | FLAG_NOTIFY | FLAG_WRITE_NO_RESPONSE,)
 MIDI_SERVICE = (MIDI_UUID,(MIDI_TXRX,),)
 
 class Useful:
-    def setup(self, name, verbose, callback):
+    # Received data goes into a ring buffer of rx_size bytes allocated here,
+    # split into messages. With delimiter=None every BLE write/notification
+    # is one message (stored behind a 2-byte length); with a delimiter such
+    # as b'\n' the data is a byte stream and messages end at the delimiter,
+    # however the sender chunked it. When the ring is full, overflow
+    # 'drop_newest' discards the incoming data and 'drop_oldest' discards
+    # buffered messages to make room; either way self.dropped counts it.
+    # A message that loses a chunk is dropped whole, never delivered cut.
+    # is_any is the number of complete messages waiting.
+    # mtu is the ATT MTU asked for when connecting; self.mtu is the one in
+    # use, and each packet carries up to mtu - 3 bytes.
+    def setup(self, name, verbose, callback, rx_size=512, delimiter=None, overflow='drop_newest', mtu=247):
         self._ble = bluetooth.BLE()
         self._ble.active(True)
+        try:
+            self._ble.config(mtu=mtu)
+        except (ValueError, OSError):
+            pass  # port without MTU configuration
         self._ble.irq(callback)
         self.name = name
-        self.string = b''
-        self.is_any = 0
         self.verbose = verbose
         self.is_connected = False
+        # ThreadSafeFlags set from the IRQ, for AsyncListen and AsyncYell.
+        self._flags = None
+        self._framing(rx_size, delimiter, overflow)
+
+    # Per-connection state: MTU, fragmentation and the receive ring.
+    def _framing(self, rx_size, delimiter, overflow):
+        assert overflow in ('drop_newest', 'drop_oldest')
+        self.mtu = ATT_MTU
+        # Fragmentation is for UART text; MIDI packets pass through as-is.
+        self._frag = True
+        self._seq = 0
+        # Message being reassembled: ring index of its length prefix (None
+        # when there is none), sequence number, last index, bytes so far.
+        self._fstart = None
+        self._fseq = 0
+        self._fidx = 0
+        self._flen = 0
+        self._ring = bytearray(rx_size)
+        self._rmv = memoryview(self._ring)
+        self._head = 0
+        self._tail = 0
+        self._used = 0
+        self.delimiter = None if delimiter is None else delimiter[0]
+        # Delimiter mode: bytes of the message not yet ended, and whether
+        # input is being skipped up to the next delimiter (see _stream()).
+        self._plen = 0
+        self._resync = False
+        self.overflow = overflow
+        self.dropped = 0
+        self.is_any = 0
+
+    def _wake(self, i):
+        if self._flags:
+            self._flags[i].set()
     
     def wait_for_connection(self, timeout = -1):
         start =  time.ticks_ms()
@@ -77,25 +144,203 @@ class Useful:
         return self.is_connected
         
     def rx(self, data):
-        self.printIt("Received: " + str(bytes(data)))
+        if self.verbose:
+            self.printIt("Received: " + str(bytes(data)))
         self.buffer(data)
-        
+        if self.is_any:
+            self._wake(WAKE_RX)
+
+    # Runs in the BLE IRQ, so it only copies bytes into the ring and never
+    # allocates (printing with verbose=True does).
     def buffer(self, value):
-        self.string = self.string + bytes(value)
-        self.is_any = len(self.string)
-        
+        n = len(value)
+        if n and value[0] == FRAG and self._frag:
+            return self._fragment(value)
+        if self.delimiter is not None:
+            return self._stream(value, 0, n)
+        if self._room(n + 2):
+            self._prefix(self._head, n)
+            self._head = (self._head + 2) % len(self._ring)
+            self._used += 2
+            self._append(value, 0, n)
+            self.is_any += 1
+
+    # Adds a fragment to the message being reassembled; a missing or
+    # out-of-order fragment discards it.
+    def _fragment(self, value):
+        n = len(value) - 3
+        seq = value[1]
+        idx = value[2] & 0x7F
+        if self.delimiter is not None:
+            # The delimiters frame the stream; fragments just carry it.
+            return self._stream(value, 3, n)
+        if idx == 0:
+            if self._fstart is not None:
+                self._abort()
+            if not self._room(n + 2):
+                return
+            self._fstart = self._head
+            self._fseq = seq
+            self._flen = 0
+            self._head = (self._head + 2) % len(self._ring)
+            self._used += 2
+        elif self._fstart is None or seq != self._fseq or idx != self._fidx + 1:
+            if self._fstart is not None:
+                self._abort()
+            else:
+                self.dropped += 1
+            return
+        elif not self._room(n):
+            self._abort()
+            return
+        self._fidx = idx
+        self._append(value, 3, n)
+        self._flen += n
+        if value[2] & 0x80:
+            self._prefix(self._fstart, self._flen)
+            self._fstart = None
+            self.is_any += 1
+
+    def _abort(self):
+        self._used -= 2 + self._flen
+        self._head = self._fstart
+        self._fstart = None
+        self.dropped += 1
+
+    def _prefix(self, i, n):
+        self._ring[i] = n >> 8
+        self._ring[(i + 1) % len(self._ring)] = n & 0xFF
+
+    # Delimiter mode: adds value[start:start + n] to the byte stream. A
+    # chunk that cannot be stored takes the unfinished message before it
+    # down too, and the stream picks up again after the next delimiter, so
+    # the pieces either side of a gap are never joined into one message.
+    def _stream(self, value, start, n):
+        if self._room(n):
+            return self._append(value, start, n)
+        self._head = (self._head - self._plen) % len(self._ring)
+        self._used -= self._plen
+        self._plen = 0
+        self._resync = value[start + n - 1] != self.delimiter
+
+    # Makes room for need more bytes as the overflow policy allows. Only
+    # complete messages are dropped, never one still being received.
+    def _room(self, need):
+        size = len(self._ring)
+        while size - self._used < need:
+            if need > size or self.overflow == 'drop_newest' or not self.is_any:
+                self.dropped += 1
+                return False
+            self._drop()
+        return True
+
+    def _append(self, value, start, n):
+        ring = self._ring
+        size = len(ring)
+        h = self._head
+        d = self.delimiter
+        skip = self._resync
+        plen = self._plen
+        k = 0
+        for i in range(start, start + n):
+            b = value[i]
+            if skip:
+                skip = b != d
+                continue
+            ring[h] = b
+            h += 1
+            if h == size:
+                h = 0
+            k += 1
+            plen += 1
+            if b == d:
+                self.is_any += 1
+                plen = 0
+        self._head = h
+        self._used += k
+        self._plen = plen
+        self._resync = skip
+
+    # value as packets of at most mtu - 3 bytes, fragmented if need be.
+    def _packets(self, value):
+        if isinstance(value, str):
+            value = value.encode()
+        size = self.mtu - 3
+        if len(value) <= size and not (value and value[0] == FRAG):
+            return (value,)
+        step = size - 3
+        n = (len(value) + step - 1) // step
+        assert n <= 128, 'message too long'
+        self._seq = (self._seq + 1) & 0xFF
+        return [
+            bytes((FRAG, self._seq, i | (0x80 if i == n - 1 else 0))) + value[i * step : (i + 1) * step]
+            for i in range(n)
+        ]
+
+    # Bytes from the tail to the first delimiter.
+    def _find(self):
+        ring = self._ring
+        size = len(ring)
+        t = self._tail
+        for i in range(self._used):
+            if ring[(t + i) % size] == self.delimiter:
+                return i
+        return -1
+
+    # Frees the oldest complete message.
+    def _drop(self):
+        ring = self._ring
+        size = len(ring)
+        t = self._tail
+        self.dropped += 1
+        if self.delimiter is None:
+            n = 2 + (ring[t] << 8 | ring[(t + 1) % size])
+        else:
+            n = self._find() + 1
+        self.is_any -= 1
+        self._tail = (t + n) % size
+        self._used -= n
+
+    def messages_available(self):
+        return self.is_any
+
+    # The oldest complete message as bytes (without delimiter), or None.
+    def read_message(self):
+        if not self.is_any:
+            return None
+        irq = machine.disable_irq()
+        try:
+            ring = self._ring
+            size = len(ring)
+            t = self._tail
+            if self.delimiter is None:
+                n = ring[t] << 8 | ring[(t + 1) % size]
+                t = (t + 2) % size
+                used = n + 2
+            else:
+                n = self._find()
+                used = n + 1
+            if t + n <= size:
+                msg = bytes(self._rmv[t : t + n])
+            else:
+                msg = bytes(self._rmv[t:]) + bytes(self._rmv[: t + n - size])
+            self._tail = (self._tail + used) % size
+            self._used -= used
+            self.is_any -= 1
+        finally:
+            machine.enable_irq(irq)
+        return msg
+
+    # One message decoded as a string, '' if none is waiting.
     def read(self):
-        if self.is_any:
-            try:
-                temp = self.string.decode()
-                self.string = b''
-                self.is_any = 0
-                return temp
-            except:
-                print('error')
-                print(self.string)
-                return ''
-        else: 
+        msg = self.read_message()
+        if msg is None:
+            return ''
+        try:
+            return msg.decode()
+        except:
+            print('error')
+            print(msg)
             return ''
             
     def printIt(self, data):
@@ -103,28 +348,149 @@ class Useful:
             print(data)
         
 #----------------Central---------------------------------
+# One peripheral connected to a Listen: its handles, MTU, receive ring and
+# send queue. Listen.links maps connection handles to these, and a Link
+# has the same is_any, read(), send() and drain() as a one-peripheral
+# Listen.
+class Link(Useful):
+    def __init__(self, central, conn_handle, addr_type, addr, name):
+        self._central = central
+        self._ble = central._ble
+        self._flags = central._flags
+        self.verbose = central.verbose
+        self.conn_handle = conn_handle
+        self.addr_type = addr_type
+        self.addr = addr
+        self.name = name
+        self._framing(*central._rx_args)
+        self.tx_size = central.tx_size  # packets send() may queue
+        self._start_handle = None
+        self._end_handle = None
+        self._tx_handle = None
+        self._rx_handle = None
+        self.is_connected = False  # until discovery finds the UART characteristics
+        # (packet, response) waiting for the controller; see _pump().
+        self._txq = []
+        self._tx_busy = False  # a write with response is outstanding
+        self._pumping = False
+
+    # Longer than mtu - 3 bytes is sent as several fragments, which the
+    # other side's buffer() puts back together. Packets are queued and
+    # written as fast as the controller takes them. send() returns once
+    # the controller has taken them all (an AsyncListen leaves the rest to
+    # a task instead); drain() also waits for the last acknowledgement.
+    def send(self, value, response=False):
+        if not self.is_connected:
+            return
+        self.printIt("sending " + str(value))
+        for packet in self._packets(value):
+            if len(self._txq) >= self.tx_size:
+                self.drain()
+                if not self.is_connected:
+                    return
+            self._txq.append((packet, 1 if response else 0))
+        self._pump()
+        if self._txq:
+            self._central._retry(self)
+
+    # Writes queued packets until the controller is out of buffers
+    # (ENOMEM) or a write with response is outstanding (ATT allows one
+    # at a time). What is left goes on the next IRQ_GATTC_WRITE_DONE, or
+    # from drain(); writes without response get no completion event.
+    def _pump(self):
+        if self._pumping:
+            return
+        self._pumping = True
+        q = self._txq
+        n = len(q)
+        try:
+            while q and not self._tx_busy:
+                packet, response = q[0]
+                try:
+                    self._ble.gattc_write(self.conn_handle, self._rx_handle, packet, response)
+                except OSError as e:
+                    if e.args[0] == errno.ENOMEM:
+                        break
+                    del q[:]
+                    raise
+                q.pop(0)
+                self._tx_busy = bool(response)
+        finally:
+            self._pumping = False
+            if len(q) < n or not self._tx_pending():
+                self._wake(WAKE_TX)
+
+    def _tx_pending(self):
+        return self.is_connected and (self._txq or self._tx_busy)
+
+    # Blocks until everything sent has been handed to the controller (and
+    # acknowledged, for writes with response) or the link drops.
+    def drain(self):
+        while self._tx_pending():
+            self._pump()
+            time.sleep_ms(1)
+
+    def _lost(self):
+        self.is_connected = False
+        del self._txq[:]
+        self._tx_busy = False
+
 class Listen(Useful):   # central
-    def __init__(self, name = None, verbose = True): 
-        self.setup(name, verbose, self._irq)
+    # Keeps a Link per connected peripheral. connect_up(count=n) brings up
+    # n peripherals named name; send_to() and broadcast() address them,
+    # and links dropping or coming back leave the others alone. is_any,
+    # read(), send() and mtu act on the first link that connected, so a
+    # one-peripheral program reads as before.
+    def __init__(self, name = None, verbose = True, rx_size = 512, delimiter = None, overflow = 'drop_newest', mtu = 247, tx_size = 32):
+        self.setup(name, verbose, self._irq, rx_size, delimiter, overflow, mtu)
+        self.tx_size = tx_size  # packets each link's send() may queue
         self._reset()
 
+    # Each Link gets its own buffers; keep the settings for them.
+    def _framing(self, rx_size, delimiter, overflow):
+        assert overflow in ('drop_newest', 'drop_oldest')
+        self._rx_args = (rx_size, delimiter, overflow)
+
     def _reset(self):
         # Cached name and address from a successful scan.
         self._name = None
         self._addr_type = None
         self._addr = None
         self.addresses = set()
+        # (addr_type, addr, name) of the peripherals the last scan found.
+        self.matches = []
+        self._want = 1
         self._conn_callback = self.connected
-#        self._read_callback = None
-        self._notify_callback = self.rx
-        self._conn_handle = None
-        self._start_handle = None
-        self._end_handle = None
-        self._tx_handle = None
-        self._rx_handle = None
-        self.is_connected = False 
-        self.scanning = False 
-        self.found = False    
+        self.links = {}
+        self.link = None
+        # Peripherals waiting for gap_connect, and the one it is working on.
+        self._pending = []
+        self._connecting = None
+        self.is_connected = False
+        self.scanning = False
+        self.found = False
+        self._wake(WAKE_CONN)
+        self._wake(WAKE_RX)
+        self._wake(WAKE_TX)
+
+    @property
+    def is_any(self):
+        return self.link.is_any if self.link else 0
+
+    @property
+    def dropped(self):
+        return self.link.dropped if self.link else 0
+
+    @property
+    def mtu(self):
+        return self.link.mtu if self.link else ATT_MTU
+
+    def read_message(self):
+        return self.link.read_message() if self.link else None
+
+    # Links with messages waiting.
+    def ready(self):
+        return [link for link in self.links.values() if link.is_any]
 
     def _irq(self, event, data):
         if event == IRQ_SCAN_RESULT: #check to see if it is a serialperipheral
@@ -133,66 +499,90 @@ class Listen(Useful):   # central
 
         elif event == IRQ_SCAN_DONE:  # close everything
             self.scanning = False
+            self._wake(WAKE_SCAN)
 
         elif event == IRQ_PERIPHERAL_CONNECT:  # ask for services
             self.printIt('\nConnect successful.')
             conn_handle, addr_type, addr = data
-            if addr_type == self._addr_type and addr == self._addr:
-                self._conn_handle = conn_handle
-                self._ble.gattc_discover_services(self._conn_handle)
+            c = self._connecting
+            if c and addr_type == c[0] and addr == c[1]:
+                self.links[conn_handle] = Link(self, conn_handle, *c)
+                self._ble.gattc_discover_services(conn_handle)
                 self.printIt('Got a connection handle: ' + str(conn_handle))
-    
+                self._next_connect()
+
         elif event == IRQ_PERIPHERAL_DISCONNECT:
             # Disconnect (either initiated by us or the remote end).
-            conn_handle, _, _ = data
+            conn_handle, addr_type, addr = data
             self.printIt('Disconnected: '+str(conn_handle))
-            if conn_handle == self._conn_handle:
-                # If it was initiated by us, it'll already be reset.
-                self._reset()
-    
+            link = self.links.pop(conn_handle, None)
+            if link:
+                self._lost(link)
+            elif self._connecting and addr == self._connecting[1]:
+                # The connection attempt failed; try the next one.
+                self._next_connect()
+
         elif event == IRQ_GATTC_SERVICE_RESULT:  # read the service
             self.printIt('Connected device returned a service.')
             conn_handle, start_handle, end_handle, uuid = data
-            if conn_handle == self._conn_handle and uuid == UART_SERVICE_UUID:
-                self._start_handle, self._end_handle = start_handle, end_handle
+            link = self.links.get(conn_handle)
+            if link and uuid == UART_SERVICE_UUID:
+                link._start_handle, link._end_handle = start_handle, end_handle
                 self.printIt('Got start and end handles: ' + str(start_handle) + ' ' + str(end_handle))
-            
+
         elif event == IRQ_GATTC_SERVICE_DONE:  #ask for characteristics
             self.printIt('Service query complete.')
-            if self._start_handle and self._end_handle:
-                self._ble.gattc_discover_characteristics(self._conn_handle, self._start_handle, self._end_handle)
+            conn_handle, status = data
+            link = self.links.get(conn_handle)
+            if link and link._start_handle and link._end_handle:
+                self._ble.gattc_discover_characteristics(conn_handle, link._start_handle, link._end_handle)
             else:
                 self.printIt("Failed to find uart service.")
-            
+
         elif event == IRQ_GATTC_CHARACTERISTIC_RESULT:  #check that it has Rx and Tx
             self.printIt('Connected device returned a characteristic.')
             conn_handle, def_handle, value_handle, properties, uuid = data
-            if conn_handle == self._conn_handle and uuid == UART_RX_CHAR_UUID:
-                self._rx_handle = value_handle
+            link = self.links.get(conn_handle)
+            if link and uuid == UART_RX_CHAR_UUID:
+                link._rx_handle = value_handle
                 self.printIt('rx handle: '+str(value_handle))
-            if conn_handle == self._conn_handle and uuid == UART_TX_CHAR_UUID:
-                self._tx_handle = value_handle
+            if link and uuid == UART_TX_CHAR_UUID:
+                link._tx_handle = value_handle
                 self.printIt('tx handle: '+str(value_handle))
-        
+
         elif event == IRQ_GATTC_CHARACTERISTIC_DONE:  #got the info - run the connection callback
             self.printIt('Characteristic query complete.')
-            if self._tx_handle is not None and self._rx_handle is not None:
+            conn_handle, status = data
+            link = self.links.get(conn_handle)
+            if link and link._tx_handle is not None and link._rx_handle is not None:
+                # Discovery is done, so the link is free for the MTU exchange.
+                self._ble.gattc_exchange_mtu(conn_handle)
                 # We've finished connecting and discovering device, fire the connect callback.
-                if self._conn_callback:
-                    self._conn_callback()
-                else:
-                    self.printIt("Failed to find uart rx characteristic.")
-        
+                self._conn_callback(link)
+            else:
+                self.printIt("Failed to find uart rx characteristic.")
+
         elif event == IRQ_GATTC_WRITE_DONE:
             conn_handle, value_handle, status = data
             self.printIt("TX complete")
-    
+            link = self.links.get(conn_handle)
+            if link:
+                link._tx_busy = False
+                link._pump()
+
+        elif event == IRQ_MTU_EXCHANGED:
+            conn_handle, mtu = data
+            link = self.links.get(conn_handle)
+            if link:
+                link.mtu = mtu
+                self.printIt('MTU: ' + str(mtu))
+
         elif event == IRQ_GATTC_NOTIFY:
             conn_handle, value_handle, notify_data = data
-            if conn_handle == self._conn_handle and value_handle == self._tx_handle:
-                if self._notify_callback:
-                    self._notify_callback(notify_data)
-                        
+            link = self.links.get(conn_handle)
+            if link and value_handle == link._tx_handle:
+                link.rx(notify_data)
+
     def uart_check(self, data):
         addr_type, addr, adv_type, rssi, adv_data = data
         if adv_type in (ADV_IND, ADV_DIRECT_IND) and UART_SERVICE_UUID in self.decode_services(adv_data):
@@ -206,14 +596,16 @@ class Listen(Useful):   # central
                 self._name = "?"
                 self.printIt("type: %s, addr: %s, name: %s, rssi: %d"%(addr_type, str(bytes(addr)), self.name, rssi))
             else:
-                if self.name == name:  # we found the right one and are done so stop scanning
+                if self.name == name:  # we found the right one; done once we have enough of them
                     self._name = name
                     self.found = True
-                    return True
+                    if len(self.matches) < self._want and not self._known(self._addr):
+                        self.matches.append((addr_type, self._addr, name))
+                    return len(self.matches) >= self._want
                 else:
                     self._name = name or "?"
                     return False
-                    
+
     def decode_field(self, payload, adv_type):
         i = 0
         result = []
@@ -243,11 +635,15 @@ class Listen(Useful):   # central
             pass
         return services
 
-    # Find a device advertising the environmental sensor service.
-    def scan(self, duration = 2000):
+    # Find devices advertising the UART service; stops once count new ones
+    # named self.name turn up. Peripherals already linked are skipped.
+    def scan(self, duration = 2000, count = 1):
         self._addr_type = None
         self._addr = None
         self.addresses = set()
+        self.matches = []
+        self._want = count
+        self.found = False
         self.scanning = True
         #run for duration sec, with checking every 30 ms for 30 ms
         duration = 0 if duration < 0 else duration
@@ -266,50 +662,162 @@ class Listen(Useful):   # central
         self._ble.gap_scan(None)
         self.scanning = False
 
-    # Connect to the specified device (otherwise use cached address from a scan).
+    # True if addr is linked or waiting to connect.
+    def _known(self, addr):
+        for link in self.links.values():
+            if link.addr == addr:
+                return True
+        for c in self._pending:
+            if c[1] == addr:
+                return True
+        return self._connecting is not None and self._connecting[1] == addr
+
+    # Connect to the peripherals found by the last scan (otherwise the
+    # cached address of the last UART device seen).
     def connect(self):
-        if self._addr_type is None or self._addr is None:
+        new = self.matches
+        if not new and self._addr is not None:
+            new = [(self._addr_type, self._addr, self._name)]
+        new = [c for c in new if not self._known(c[1])]
+        if not new:
             print('error in assigning addresses')
             return False
-        self._ble.gap_connect(self._addr_type, self._addr)
+        self._pending.extend(new)
+        if self._connecting is None:
+            self._next_connect()
         return True
 
-    # Disconnect from current device.
-    def disconnect(self):
-        if not self._conn_handle:
+    # The controller creates one connection at a time, so connects queue
+    # up here; discovery on the links already made goes on meanwhile.
+    def _next_connect(self):
+        self._connecting = None
+        while self._pending:
+            c = self._pending.pop(0)
+            try:
+                self._ble.gap_connect(c[0], c[1])
+            except OSError as e:
+                self.printIt('connect failed: ' + str(e))
+                continue
+            self._connecting = c
             return
-        self._ble.gap_disconnect(self._conn_handle)
-        self._reset()       
 
-    def connected(self):
-        self.is_connected = True
+    # Link for a connection handle, or the Link itself.
+    def _link(self, conn):
+        return conn if isinstance(conn, Link) else self.links.get(conn)
 
-    def connect_up(self, timeout = -1):
-        self.scan(timeout)
-        self.wait_for_scan()
-        if self.found:
+    # Disconnect from one peripheral (a Link or its handle), or from all.
+    def disconnect(self, conn = None):
+        if conn is None:
+            # Links the caller still holds must read as down too.
+            for conn_handle, link in self.links.items():
+                self._ble.gap_disconnect(conn_handle)
+                self._lost(link)
+            self._reset()
+            return
+        link = self._link(conn)
+        if link and self.links.pop(link.conn_handle, None):
+            self._ble.gap_disconnect(link.conn_handle)
+            self._lost(link)
+
+    def connected(self, link):
+        link.is_connected = True
+        self._update()
+        self._wake(WAKE_CONN)
+
+    def _lost(self, link):
+        link._lost()
+        self._update()
+        self._wake(WAKE_CONN)
+        self._wake(WAKE_RX)
+        self._wake(WAKE_TX)
+
+    # Picks the link the one-peripheral API uses. A lost link stays until
+    # another is up, so its unread messages can still be read.
+    def _update(self):
+        up = self._up()
+        if up and (self.link is None or not self.link.is_connected):
+            self.link = up[0]
+        self.is_connected = bool(up)
+
+    def _up(self):
+        return [link for link in self.links.values() if link.is_connected]
+
+    def wait_for_connection(self, timeout = -1, count = 1):
+        start =  time.ticks_ms()
+        done = False
+        while not done:
+            done = len(self._up()) >= count
+            if not done and timeout >= 0:
+                done = (time.ticks_ms()-start) >= timeout
+            time.sleep(0.1)
+            if self.verbose:
+                print('.',end='')
+        return len(self._up()) >= count
+
+    # Returns True once count peripherals are connected; links that are
+    # already up count, so after a drop only the missing ones are redone.
+    def connect_up(self, timeout = -1, count = 1):
+        need = count - len(self.links)
+        if need > 0:
+            self.scan(timeout, need)
+            self.wait_for_scan()
+            if not self.found:
+                return False
             self.connect()
-            return self.wait_for_connection(timeout)
-        else:
-            return False
+        return self.wait_for_connection(timeout, count)
 
     def send(self, value, response=False):
-        if not self.is_connected:
-            return
-        self.printIt("sending " + value)
-        return self._ble.gattc_write(self._conn_handle, self._rx_handle, value, 1 if response else 0)
+        self.send_to(self.link, value, response)
+
+    # Sends to one peripheral, given its Link or connection handle.
+    def send_to(self, conn, value, response=False):
+        link = self._link(conn)
+        if link:
+            link.send(value, response)
+
+    def broadcast(self, value, response=False):
+        for link in self._up():
+            link.send(value, response)
+
+    def _pump(self):
+        for link in self._up():
+            link._pump()
+
+    def _tx_pending(self):
+        for link in self._up():
+            if link._tx_pending():
+                return True
+        return False
+
+    # Blocks until every link's send queue is empty (see Link.drain()).
+    def drain(self):
+        while self._tx_pending():
+            self._pump()
+            time.sleep_ms(1)
+
+    # Link.send() could not hand every packet to the controller. Nothing
+    # will pump the rest of a write without response (it gets no
+    # IRQ_GATTC_WRITE_DONE), so keep at it until they are all taken.
+    def _retry(self, link):
+        while link.is_connected and link._txq:
+            link._pump()
+            time.sleep_ms(1)
 
 #-------------------Peripheral---------------------------------------------------------------------------------------------------------------                
 class Yell(Useful): 
-    def __init__(self, name = 'Pico', interval_us=10000, verbose = True, type = 'uart'):
-        self.setup(name, verbose, self._irq)
+    def __init__(self, name = 'Pico', interval_us=10000, verbose = True, type = 'uart', rx_size = 512, delimiter = None, overflow = 'drop_newest', mtu = 247):
+        self.setup(name, verbose, self._irq, rx_size, delimiter, overflow, mtu)
         self.service = UART_UUID if type == 'uart' else MIDI_UUID
         services = [self.service]
         if type == 'uart':
             ((self._handle_tx, self._handle_rx),) = self._ble.gatts_register_services((UART_SERVICE,))
+            # The characteristic holds 20 bytes by default and longer writes
+            # are cut short; make room for a full packet at the MTU asked for.
+            self._ble.gatts_set_buffer(self._handle_rx, mtu - 3)
         elif type == 'midi':
             ((self._handle_tx, ),) = self._ble.gatts_register_services((MIDI_SERVICE,))
             self._handle_rx = self._handle_tx   # same handle for both directions
+            self._frag = False
         else:
             print('unsupported type')
         self._connections = set()
@@ -332,8 +840,11 @@ class Yell(Useful):
     def _irq(self, event, data):  # Track connections so we can send notifications.
         if event == IRQ_CENTRAL_CONNECT:
             conn_handle, _, _ = data
+            if not self._connections:
+                self.mtu = ATT_MTU
             self._connections.add(conn_handle)
             self.is_connected = True
+            self._wake(WAKE_CONN)
             self.printIt("Connected: "+str(conn_handle))
             
         elif event == IRQ_CENTRAL_DISCONNECT:
@@ -341,6 +852,8 @@ class Yell(Useful):
             self._connections.remove(conn_handle)
             #self._write_callback = None
             self.is_connected = False  #assuming only one connection
+            self._wake(WAKE_CONN)
+            self._wake(WAKE_RX)
             self.printIt("Disconnected: " + str(conn_handle))
             
         elif event == IRQ_GATTS_WRITE:
@@ -348,6 +861,12 @@ class Yell(Useful):
             value = self._ble.gatts_read(value_handle)
             if value_handle == self._handle_rx and self._write_callback:
                 self._write_callback(value)
+
+        elif event == IRQ_MTU_EXCHANGED:
+            # Notifications go to every central, so use the smallest MTU.
+            conn_handle, mtu = data
+            self.mtu = mtu if len(self._connections) == 1 else min(self.mtu, mtu)
+            self.printIt('MTU: ' + str(mtu))
         
     def disconnect(self):
         for conn_handle in self._connections:
@@ -362,12 +881,117 @@ class Yell(Useful):
         self.stop_advertising()
         return success
     
+    # Like Listen.send(), long UART messages are fragmented; MIDI packets
+    # are sent as they are.
     def send(self, data):
         if not self.is_connected:
             return
+        packets = self._packets(data) if self._frag else (data,)
         for conn_handle in self._connections:
-            self._ble.gatts_notify(conn_handle, self._handle_tx, data)
+            for packet in packets:
+                self._ble.gatts_notify(conn_handle, self._handle_tx, packet)
         self.printIt("sent to %d central(s): %s" % (len(self._connections), data))
+
+#-------------------Async---------------------------------------------------------------------------------------------------------------------
+# Awaitable versions of the blocking calls, for programs running other
+# asyncio tasks. The IRQ sets a ThreadSafeFlag when the connection state
+# changes, a scan ends or a message arrives, so waiting costs no polling
+# and wakes as soon as the radio event is handled. One task at a time may
+# wait for each kind of event.
+class _Async:
+    def _async_setup(self):
+        self._flags = (asyncio.ThreadSafeFlag(), asyncio.ThreadSafeFlag(), asyncio.ThreadSafeFlag(), asyncio.ThreadSafeFlag())
+
+    # Waits for done() to become true, rechecking whenever flag i is set.
+    # Gives up after timeout ms unless timeout is negative.
+    async def _until(self, i, done, timeout=-1):
+        async def wait():
+            while not done():
+                await self._flags[i].wait()
+        if timeout < 0:
+            await wait()
+        else:
+            try:
+                await asyncio.wait_for(wait(), timeout / 1000)
+            except asyncio.TimeoutError:
+                pass
+
+    async def wait_for_connection(self, timeout = -1):
+        await self._until(WAKE_CONN, lambda: self.is_connected, timeout)
+        return self.is_connected
+
+    # Waits for a message; returns how many are waiting, 0 if the timeout
+    # passed or the connection went down first.
+    async def wait_message(self, timeout = -1):
+        await self._until(WAKE_RX, lambda: self.is_any or not self.is_connected, timeout)
+        return self.is_any
+
+    # The next message as bytes, or None (see wait_message()).
+    async def recv(self, timeout = -1):
+        await self.wait_message(timeout)
+        return self.read_message()
+
+class AsyncListen(_Async, Listen):
+    def __init__(self, *args, **kw):
+        Listen.__init__(self, *args, **kw)
+        self._async_setup()
+        self._drainer = None  # task started by _retry()
+
+    # Returns True if a peripheral with the name was found.
+    async def scan(self, duration = 2000, count = 1):
+        Listen.scan(self, duration, count)
+        await self.wait_for_scan()
+        return self.found
+
+    async def wait_for_scan(self):
+        await self._until(WAKE_SCAN, lambda: not self.scanning)
+
+    async def wait_for_connection(self, timeout = -1, count = 1):
+        await self._until(WAKE_CONN, lambda: len(self._up()) >= count, timeout)
+        return len(self._up()) >= count
+
+    async def connect_up(self, timeout = -1, count = 1):
+        need = count - len(self.links)
+        if need > 0:
+            if not await self.scan(timeout, need):
+                return False
+            self.connect()
+        return await self.wait_for_connection(timeout, count)
+
+    # Waits for a message on any link; returns the links with messages
+    # waiting (see ready()), empty if the timeout passed or none is up.
+    async def wait_any(self, timeout = -1):
+        await self._until(WAKE_RX, lambda: self.ready() or not self.is_connected, timeout)
+        return self.ready()
+
+    # Like Listen.drain(), but lets other tasks run. Retries after each
+    # completion event, or within 10 ms for writes without response.
+    async def drain(self):
+        while self._tx_pending():
+            self._pump()
+            if self._tx_pending():
+                try:
+                    await asyncio.wait_for(self._flags[WAKE_TX].wait(), 0.01)
+                except asyncio.TimeoutError:
+                    pass
+
+    # Rather than block the event loop in send(), drain in a task.
+    def _retry(self, link):
+        if self._drainer is None or self._drainer.done():
+            self._drainer = asyncio.create_task(self.drain())
+
+class AsyncYell(_Async, Yell):
+    def __init__(self, *args, **kw):
+        Yell.__init__(self, *args, **kw)
+        self._async_setup()
+
+    async def connect_up(self, timeout = -1):
+        self.advertise()
+        success = await self.wait_for_connection(timeout)
+        if success:
+            self.printIt("\nConnected to central")
+        self.stop_advertising()
+        return success
 '''
 def main(mode = 'P'): 
     if mode == 'P':
@@ -32,6 +32,8 @@ print("WiFi Connected ", wlan.ifconfig())
 topic_pub = 'ME35-24/camera-test'
 
 client = MQTTClient('ME35_chris', mqtt_broker, port=1883, keepalive=60)
+# Only send a tag id when it changes, and at most every 100 ms
+client.set_policy(topic_pub.encode(), min_ms=100, dedup=True)
 client.connect()
 print('Connected to %s MQTT broker' % (mqtt_broker))
 
@@ -64,5 +66,7 @@ while True:
         msg = f"{print_args[1]}"
         print(msg)
         client.publish(topic_pub.encode(),msg.encode())
+    # Keeps the link alive while dedup holds back an unchanged tag id.
+    client.check_msg()
             
     
\ No newline at end of file
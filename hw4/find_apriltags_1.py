@@ -29,12 +29,21 @@ while not wlan.isconnected():
 # We should have a valid IP now via DHCP
 print("WiFi Connected ", wlan.ifconfig())
 
-topic_pub = 'ME35-24/camera-test'
+topic_pub = b'ME35-24/camera-test'
 
-client = MQTTClient('ME35_openmv', mqtt_broker, port=1883, keepalive=60)
+# MQTT 5 lets repeated publishes carry a 2-byte topic alias instead of the topic
+client = MQTTClient('ME35_openmv', mqtt_broker, port=1883, keepalive=60, protocol=5)
+# Publishes for all tags in a frame leave in one write, see check_msg() below
+client.set_coalesce()
+# Only send a command when it changes, and at most every 100 ms
+client.set_policy(topic_pub, min_ms=100, dedup=True)
 client.connect()
 print('Connected to %s MQTT broker' % (mqtt_broker))
 
+# Payloads are written straight into the client's outgoing buffer so the
+# loop below does not allocate a message per frame.
+payload = client.payload_buf(topic_pub)
+
 
 sensor.reset()
 sensor.set_pixformat(sensor.RGB565)
@@ -61,7 +70,11 @@ while True:
         img.draw_rectangle(tag.rect(), color=(255, 0, 0))
         img.draw_cross(tag.cx(), tag.cy(), color=(0, 255, 0))
         print_args = (tag.family(), tag.id(), (180 * tag.rotation()) / math.pi)
-        msg = 'turn_right'
+        msg = b'turn_right'
         print(msg)
-        client.publish(topic_pub.encode(),msg.encode())
+        payload[:len(msg)] = msg
+        client.publish_into(topic_pub, len(msg))
+    # Flushes the frame's publishes and keeps the link alive while the
+    # policy holds back unchanged commands.
+    client.check_msg()
 
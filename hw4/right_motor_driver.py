@@ -1,8 +1,8 @@
-from BLE_CEEO import Yell
+from BLE_CEEO import AsyncYell
 from machine import Pin, PWM
 import time
 import network
-from mqtt import MQTTClient
+from mqtt_async import AsyncMQTTClient
 import uasyncio as asyncio  # Use MicroPython's version of asyncio
 
 # Wi-Fi configuration
@@ -59,13 +59,13 @@ def motor_stop():
 async def ble_peripheral(name): 
     global run_motor  
     try:
-        p = Yell(name, verbose=True)
-        if p.connect_up():
+        p = AsyncYell(name, verbose=True)
+        if await p.connect_up():
             print('BLE connected')
             await asyncio.sleep(2)  # Short delay after connection
             
             while True:
-                if p.is_any:
+                while p.is_any:
                     message = p.read()  
                     print(f"Received BLE message: {message}")
                     
@@ -86,7 +86,7 @@ async def ble_peripheral(name):
                     print('BLE connection lost')
                     break
                 
-                await asyncio.sleep(1)  
+                await p.wait_message()  # until the next message or a disconnect
 
     except Exception as e:
         print(f"Error: {e}")
@@ -114,14 +114,13 @@ def mqtt_callback(topic, msg):
         print(f"MQTT: Unknown command: {msg}")
 
 # MQTT setup function
-def mqtt_setup():
+async def mqtt_setup():
     mqtt_broker = 'broker.hivemq.com'
     port = 1883
     topic_sub = 'ME35-24/camera-test'
-    client = MQTTClient('ME35_right_motor', mqtt_broker, port, keepalive=30)
-    client.set_callback(mqtt_callback)
-    client.connect()  
-    client.subscribe(topic_sub.encode())  
+    client = AsyncMQTTClient('ME35_right_motor', mqtt_broker, port, keepalive=30)
+    await client.connect()  
+    await client.subscribe(topic_sub.encode())  
     return client
 
 # Main loop
@@ -133,11 +132,11 @@ async def main():
     print("BLE peripheral task started.")
     
     # Set up MQTT
-    client = mqtt_setup()
+    client = await mqtt_setup()
     
-    while True:
-        client.check_msg()  
-        await asyncio.sleep(0.5)
+    # Messages are handled as soon as they arrive instead of polling
+    async for topic, msg in client:
+        mqtt_callback(topic, msg)
 
 # Start the event loop
 asyncio.run(main())
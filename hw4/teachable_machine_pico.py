@@ -30,7 +30,7 @@ def peripheral(name):
             time.sleep(2)  # Short delay after connection
             
             while True:
-                if p.is_any:  # Check if there's a message to read
+                while p.is_any:  # Handle every message that arrived
                     message = p.read()  # Read the BLE message
                     
                     # Example message format: 'Start: 1.00, Stop: 0.00'
@@ -252,7 +252,7 @@ async def mqtt_client():
     client.set_callback(mqtt_callback)  
     client.connect()
     print('Connected to MQTT broker')
-    client.subscribe(topic_sub.encode())
+    client.subscribe(topic_sub.encode(), qos=2)  # start/stop applied exactly once
     while True:
         client.check_msg()  
         await asyncio.sleep(0.1) 
@@ -1,12 +1,83 @@
+import errno
+import select
 import socket
 import struct
+import time
 from binascii import hexlify
 
+try:
+    from time import ticks_ms, ticks_us, ticks_diff
+except ImportError:
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_us():
+        return int(monotonic() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
 
 class MQTTException(Exception):
     pass
 
 
+# Upper bounds of the histogram buckets; a last bucket counts the rest.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+_TYPES = (
+    None, "connect", "connack", "publish", "puback", "pubrec", "pubrel", "pubcomp",
+    "subscribe", "suback", "unsubscribe", "unsuback", "pingreq", "pingresp", "disconnect", "auth",
+)
+
+
+# Transport statistics, kept by MQTTClient after set_stats(). tx and rx
+# hold [packets, bytes] per packet type, flattened (type * 2). rtt is a
+# histogram over BUCKETS of milliseconds from sending a PUBLISH, PUBREL,
+# SUBSCRIBE or UNSUBSCRIBE to its acknowledgement, cb one of microseconds
+# spent in message callbacks. empty_polls counts poll()/check_msg() calls
+# that found nothing to handle.
+class Stats:
+    def __init__(self):
+        self.connect_ms = None
+        # SUBSCRIBE/UNSUBSCRIBE ids -> ticks sent.
+        self._sent = {}
+        self.reset()
+
+    def reset(self):
+        self.tx = [0] * 32
+        self.rx = [0] * 32
+        self.rtt = [0] * (len(BUCKETS) + 1)
+        self.cb = [0] * (len(BUCKETS) + 1)
+        self.empty_polls = 0
+
+    @staticmethod
+    def count(a, t, n, pkts=1):
+        a[t * 2] += pkts
+        a[t * 2 + 1] += n
+
+    @staticmethod
+    def hist(h, v):
+        i = 0
+        while i < len(BUCKETS) and v > BUCKETS[i]:
+            i += 1
+        h[i] += 1
+
+    # The counters as a dict, with packet types named.
+    def snapshot(self):
+        d = {}
+        for k in ("tx", "rx"):
+            a = getattr(self, k)
+            d[k] = {_TYPES[t]: a[t * 2 : t * 2 + 2] for t in range(1, 16) if a[t * 2 + 1]}
+        d["rtt_ms"] = self.rtt[:]
+        d["cb_us"] = self.cb[:]
+        d["buckets"] = BUCKETS
+        d["empty_polls"] = self.empty_polls
+        d["connect_ms"] = self.connect_ms
+        return d
+
+
 class MQTTClient:
     def __init__(
         self,
@@ -17,14 +88,33 @@ class MQTTClient:
         password=None,
         keepalive=0,
         ssl=None,
+        rbuf_size=256,
+        wbuf_size=256,
+        max_inflight=1,
+        retry_ms=5000,
+        max_rx_pids=16,
+        rx_view=False,
+        protocol=4,
+        dns_ttl_ms=300000,
     ):
         if port == 0:
             port = 8883 if ssl else 1883
         self.client_id = client_id
         self.sock = None
+        self._poller = None
         self.server = server
         self.port = port
         self.ssl = ssl
+        # (host, port) -> (address, ticks resolved); entries older than
+        # dns_ttl_ms are looked up again. _servers are the fallbacks from
+        # set_fallbacks() and _good the index of the last one that worked
+        # (0 being server/port).
+        self._dns = {}
+        self.dns_ttl_ms = dns_ttl_ms
+        self._servers = []
+        self._good = 0
+        # Milliseconds the last connect() took, DNS to CONNACK.
+        self.connect_ms = None
         self.pid = 0
         self.cb = None
         self.user = user
@@ -34,24 +124,568 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        # CONNECT packets already built, keyed by clean_session.
+        self._cpkt = {}
+        # 4 is MQTT 3.1.1, 5 is MQTT 5.0. Under 5, topic_alias_max is the
+        # broker's Topic Alias Maximum from CONNACK and _aliases maps topics
+        # to the aliases assigned on this connection.
+        assert protocol in (4, 5)
+        self.protocol = protocol
+        self.topic_alias_max = 0
+        self._aliases = {}
+        self._hot = set()
+        self.session_expiry = 0
+        self._rbuf = bytearray(rbuf_size)
+        self._rmv = memoryview(self._rbuf)
+        self._rpos = 0
+        self._rlen = 0
+        self._skip = 0
+        # Inbound publish being streamed to chunk_cb: [topic, bytes
+        # delivered, payload length].
+        self.chunk_cb = None
+        self._sink = None
+        self.rx_view = rx_view
+        self._wbuf = bytearray(wbuf_size)
+        self._wmv = memoryview(self._wbuf)
+        self._connack = None
+        # SUBSCRIBE/UNSUBSCRIBE ids -> None while pending, then the SUBACK
+        # return codes (b"" for an MQTT 3.1.1 UNSUBACK) until collected by
+        # wait_suback().
+        self._subacks = {}
+        # Requests behind the pending ids, for _try_reconnect() to send
+        # again; _moved maps an id it replaced to the new one.
+        self._subreq = {}
+        self._moved = {}
+        # QoS 1/2 publishes awaiting acknowledgement: pid -> [packet, ticks
+        # sent]. packet is the PUBLISH, or the PUBREL once PUBREC arrived.
+        self._inflight = {}
+        self.max_inflight = max_inflight
+        self.retry_ms = retry_ms
+        # Ids of inbound QoS 2 publishes delivered but not yet released,
+        # oldest first.
+        self._rx_pids = []
+        self.max_rx_pids = max_rx_pids
+        # Topic trie of per-filter handlers. A node is [children, handlers]
+        # with children keyed by topic level, including b"+" and b"#".
+        self._subs = [{}, []]
+        self._last_tx = 0
+        self._last_rx = 0
+        self._ping_sent = None
+        # Auto-reconnect, see set_reconnect(). _topics remembers every
+        # subscription (topic -> qos) so it can be replayed.
+        self._auto = False
+        self._topics = {}
+        self._resub = False
+        self._offline = []
+        self.dropped = 0
+        # Write coalescing, see set_coalesce().
+        self._cbuf = None
+        self._clen = 0
+        # Per-topic publish policies, see set_policy().
+        self._policy = {}
+        # Stats object while set_stats() is on. Every hook tests for None
+        # first, so disabled statistics cost one attribute check.
+        self.stats = None
+        # Last-value cache, see set_cache(): topic -> [seq, msg].
+        self._lvc = None
+        self.seq = 0
 
-    def _send_str(self, s):
-        self.sock.write(struct.pack("!H", len(s)))
-        self.sock.write(s)
+    # Outgoing packets are assembled in self._wbuf and sent with a single
+    # write. _wreserve() grows the buffer for the rare packet that does not
+    # fit (long credentials or will messages).
+    def _wreserve(self, n):
+        if n > len(self._wbuf):
+            self._wbuf = bytearray(n)
+            self._wmv = memoryview(self._wbuf)
+        return self._wbuf
 
-    def _recv_len(self):
-        n = 0
-        sh = 0
-        while 1:
-            b = self.sock.read(1)[0]
+    def _put_len(self, i, sz):
+        buf = self._wbuf
+        while sz > 0x7F:
+            buf[i] = (sz & 0x7F) | 0x80
+            sz >>= 7
+            i += 1
+        buf[i] = sz
+        return i + 1
+
+    def _put_str(self, i, s):
+        if isinstance(s, str):
+            s = s.encode()
+        n = len(s)
+        struct.pack_into("!H", self._wbuf, i, n)
+        self._wbuf[i + 2 : i + 2 + n] = s
+        return i + 2 + n
+
+    # Reads a variable byte integer at self._rbuf[i:end]. Returns the value
+    # and the index after it, or None if it is not complete yet.
+    def _get_len(self, i, end):
+        buf = self._rbuf
+        n = sh = 0
+        while i < end:
+            b = buf[i]
+            i += 1
             n |= (b & 0x7F) << sh
             if not b & 0x80:
-                return n
+                return n, i
             sh += 7
+        return None
+
+    def _send(self, start, end):
+        self._write(self._wmv[start:end])
+
+    # more marks the rest of a PUBLISH written after its header.
+    def _write(self, data, more=False):
+        self._last_tx = now = ticks_ms()
+        if self.stats is not None:
+            Stats.count(self.stats.tx, 3 if more else data[0] >> 4, len(data), not more)
+        if self._cbuf is None:
+            return self._out(data)
+        n = len(data)
+        if self._clen + n > len(self._cbuf):
+            self.flush()
+            if n > len(self._cbuf):
+                return self._out(data)
+        if not self._clen:
+            self._cfirst = now
+        self._cbuf[self._clen : self._clen + n] = data
+        self._clen += n
+        if self._clen >= len(self._cbuf) or ticks_diff(now, self._cfirst) >= self.latency_ms:
+            self.flush()
+
+    # Makes outgoing packets collect in a buffer of threshold bytes instead
+    # of each going out in its own write. The buffer is flushed when it
+    # fills, when its oldest byte has waited latency_ms (checked on every
+    # write and poll), on every check_msg()/wait_msg(), and by flush(). A
+    # loop that only publishes should call flush() once per iteration.
+    def set_coalesce(self, threshold=512, latency_ms=20):
+        self._cbuf = bytearray(threshold)
+        self._cmv = memoryview(self._cbuf)
+        self._clen = 0
+        self.latency_ms = latency_ms
+
+    def flush(self):
+        if self._clen:
+            n = self._clen
+            self._clen = 0
+            self._out(self._cmv[:n])
+
+    # The socket is non-blocking while connected (see _fill()), so a write
+    # may take only part of data; wait for room and write the rest.
+    def _out(self, data):
+        n = self.sock.write(data)
+        if n == len(data):
+            return
+        mv = memoryview(data)[n or 0 :]
+        while mv:
+            self._poller.modify(self.sock, select.POLLOUT)
+            try:
+                self._poller.poll(-1)
+            finally:
+                self._poller.modify(self.sock, select.POLLIN)
+            mv = mv[self.sock.write(mv) or 0 :]
+
+    def _new_pid(self):
+        pid = self.pid
+        while 1:
+            pid = pid % 65535 + 1
+            if pid not in self._inflight and pid not in self._subacks:
+                self.pid = pid
+                return pid
+
+    # Reads whatever the socket has into the free tail of the receive
+    # buffer in one call. MicroPython's readinto() on a blocking socket only
+    # returns once the whole buffer is full, so connect() makes the socket
+    # non-blocking for the life of the connection; wait on self._poller
+    # first. Returns None if there was no data yet.
+    def _fill(self):
+        self._compact()
+        n = self.sock.readinto(self._rmv[self._rlen :])
+        if n is None:
+            return None
+        if n == 0:
+            raise OSError(-1)
+        self._rlen += n
+        self._last_rx = ticks_ms()
+        self._ping_sent = None
+        return n
+
+    def _compact(self):
+        if self._rpos:
+            n = self._rlen - self._rpos
+            if n:
+                self._rbuf[:n] = self._rbuf[self._rpos : self._rlen]
+            self._rpos = 0
+            self._rlen = n
+
+    # Handles every complete packet held in the receive buffer (or just the
+    # first one if one is True). A trailing partial packet stays in the
+    # buffer until the next _fill(). Returns the op of the last packet.
+    def _parse(self, one=False):
+        op = None
+        buf = self._rbuf
+        if self._skip:
+            n = min(self._skip, self._rlen - self._rpos)
+            if self._sink is not None:
+                self._chunk(self._rpos, n)
+            self._skip -= n
+            self._rpos += n
+        while self._rlen - self._rpos >= 2:
+            pos = self._rpos
+            i = pos + 1
+            sz = 0
+            sh = 0
+            while 1:
+                if i == self._rlen:
+                    return op
+                b = buf[i]
+                i += 1
+                sz |= (b & 0x7F) << sh
+                if not b & 0x80:
+                    break
+                sh += 7
+            if i + sz > self._rlen:
+                if i - pos + sz > len(buf) and not self._oversize(pos, i, sz):
+                    # Packet does not fit: grow the buffer to hold it.
+                    buf = bytearray(i - pos + sz)
+                    buf[: self._rlen - pos] = self._rbuf[pos : self._rlen]
+                    self._rbuf = buf
+                    self._rmv = memoryview(buf)
+                    self._rlen -= pos
+                    self._rpos = 0
+                return op
+            self._rpos = i + sz
+            op = buf[pos]
+            if self.stats is not None:
+                Stats.count(self.stats.rx, op >> 4, i + sz - pos)
+            self._handle(op, i, sz)
+            if one:
+                break
+        return op
+
+    # Called for a packet larger than the receive buffer. A PUBLISH that no
+    # handler wants is acknowledged and its payload dropped as it streams
+    # in, without growing the buffer for it; with a chunk callback set,
+    # every PUBLISH is passed to it piece by piece instead. Returns False if
+    # the buffer has to grow to hold the packet.
+    def _oversize(self, pos, i, sz):
+        buf = self._rbuf
+        op = buf[pos]
+        if op & 0xF0 != 0x30:
+            return False
+        end = self._rlen
+        # Until topic, id and properties are in, wait for more bytes while
+        # the buffer has room for them.
+        wait = end - pos < len(buf)
+        if end - i < 2:
+            return wait
+        t = i + 2 + (buf[i] << 8 | buf[i + 1])
+        q = t + 2 if op & 6 else t
+        if self.protocol == 5 and q <= end:
+            r = self._get_len(q, end)
+            if r is None:
+                return wait
+            q = r[1] + r[0]
+        if q - pos > len(buf):
+            return False
+        if q > end:
+            return True
+        topic = bytes(self._rmv[i + 2 : t])
+        sink = self.chunk_cb is not None
+        if not sink and self._wants(topic):
+            return False
+        if op & 6:
+            pid = buf[t] << 8 | buf[t + 1]
+            if op & 6 == 4 and sink:
+                if pid in self._rx_pids:
+                    sink = False
+                else:
+                    if len(self._rx_pids) >= self.max_rx_pids:
+                        self._rx_pids.pop(0)
+                    self._rx_pids.append(pid)
+            self._ack(0x40 if op & 6 == 2 else 0x50, pid)
+        self._skip = i + sz - end
+        self._rpos = end
+        if self.stats is not None:
+            Stats.count(self.stats.rx, 3, i + sz - pos)
+        if sink:
+            self._sink = [topic, 0, i + sz - q]
+            self._chunk(q, end - q)
+        return True
+
+    def _chunk(self, a, n):
+        s = self._sink
+        if n:
+            self.chunk_cb(s[0], self._rmv[a : a + n], s[1], s[2])
+            s[1] += n
+        if s[1] == s[2]:
+            self._sink = None
+
+    def _handle(self, op, p, sz):
+        buf = self._rbuf
+        if op & 0xF0 == 0x30:
+            t = p + 2 + (buf[p] << 8 | buf[p + 1])
+            q = t
+            if op & 6:
+                pid = buf[q] << 8 | buf[q + 1]
+                q += 2
+            if self.protocol == 5:
+                n, q = self._get_len(q, p + sz)
+                q += n  # properties are not used
+            if op & 6 == 4:
+                # QoS 2: deliver once, then answer PUBREC for every copy
+                # until the broker releases the id with PUBREL.
+                if pid not in self._rx_pids:
+                    if len(self._rx_pids) >= self.max_rx_pids:
+                        self._rx_pids.pop(0)
+                    self._rx_pids.append(pid)
+                    self._deliver(p + 2, t, q, p + sz)
+                self._ack(0x50, pid)
+                return
+            self._deliver(p + 2, t, q, p + sz)
+            if op & 6 == 2:
+                self._ack(0x40, pid)
+        elif op == 0x20:  # CONNACK
+            self._connack = (buf[p], buf[p + 1])
+            if self.protocol == 5:
+                self._connack_props(p + 2, p + sz)
+        elif op == 0x40 or op == 0x70:  # PUBACK, PUBCOMP
+            e = self._inflight.pop(buf[p] << 8 | buf[p + 1], None)
+            if e and self.stats is not None:
+                Stats.hist(self.stats.rtt, ticks_diff(ticks_ms(), e[1]))
+        elif op == 0x50:  # PUBREC
+            pid = buf[p] << 8 | buf[p + 1]
+            e = self._inflight.get(pid)
+            if e and self.stats is not None:
+                Stats.hist(self.stats.rtt, ticks_diff(ticks_ms(), e[1]))
+            if sz > 2 and buf[p + 2] >= 0x80:
+                # MQTT 5 reason code: the broker refused the message.
+                self._inflight.pop(pid, None)
+            elif e:
+                e[0] = self._ack(0x62, pid)
+                e[1] = ticks_ms()
+        elif op == 0x62:  # PUBREL
+            pid = buf[p] << 8 | buf[p + 1]
+            if pid in self._rx_pids:
+                self._rx_pids.remove(pid)
+            self._ack(0x70, pid)
+        elif op == 0x90 or op == 0xB0:  # SUBACK, UNSUBACK
+            pid = buf[p] << 8 | buf[p + 1]
+            if self.stats is not None:
+                t = self.stats._sent.pop(pid, None)
+                if t is not None:
+                    Stats.hist(self.stats.rtt, ticks_diff(ticks_ms(), t))
+            if pid in self._subacks:
+                self._subacks[pid] = self._codes(p + 2, p + sz)
+                self._subreq.pop(pid, None)
+        elif op == 0xD0:  # PINGRESP
+            assert sz == 0
+            self._ping_sent = None
+
+    # SUBACK/UNSUBACK return codes at self._rbuf[i:end], after skipping the
+    # MQTT 5 properties. Codes of 0x80 and above are failures.
+    def _codes(self, i, end):
+        if self.protocol == 5:
+            n, i = self._get_len(i, end)
+            i += n
+        return bytes(self._rmv[i:end])
+
+    # Picks the MQTT 5 CONNACK properties the client acts on: Server Keep
+    # Alive replaces the keepalive asked for, Receive Maximum caps the
+    # in-flight window and Topic Alias Maximum enables topic aliases. Other
+    # properties are skipped by their encoding.
+    def _connack_props(self, i, end):
+        buf = self._rbuf
+        n, i = self._get_len(i, end)
+        end = i + n
+        while i < end:
+            pid = buf[i]
+            i += 1
+            if pid in (0x13, 0x21, 0x22, 0x23):
+                v = buf[i] << 8 | buf[i + 1]
+                if pid == 0x13:
+                    self.keepalive = v
+                elif pid == 0x21:
+                    self.max_inflight = min(self.max_inflight, v)
+                elif pid == 0x22:
+                    self.topic_alias_max = v
+                i += 2
+            elif pid in (0x02, 0x11, 0x18, 0x27):
+                i += 4
+            elif pid == 0x0B:
+                i = self._get_len(i, end)[1]
+            elif pid == 0x26:
+                i += 2 + (buf[i] << 8 | buf[i + 1])
+                i += 2 + (buf[i] << 8 | buf[i + 1])
+            elif pid in (0x03, 0x08, 0x09, 0x12, 0x15, 0x16, 0x1A, 0x1C, 0x1F):
+                i += 2 + (buf[i] << 8 | buf[i + 1])
+            else:
+                i += 1
+
+    # Hands the topic at self._rbuf[t0:t1] and payload at [a:b] to every
+    # handler whose filter matches, or to the callback set by set_callback()
+    # if none does. Nothing is copied out of the buffer unless someone takes
+    # the message. With rx_view set, handlers get memoryview slices of the
+    # receive buffer instead of bytes: no allocation per message, but the
+    # views are only valid until the handler returns and must be copied
+    # (bytes(msg)) to be kept.
+    def _deliver(self, t0, t1, a, b):
+        mv = self._rmv
+        topic = hs = None
+        if self._lvc is not None:
+            topic = bytes(mv[t0:t1])
+            self._remember(topic, bytes(mv[a:b]))
+        if self._subs[0]:
+            if topic is None:
+                topic = bytes(mv[t0:t1])
+            hs = self._match(topic)
+        if not hs:
+            if self.cb is None:
+                return
+            hs = (self.cb,)
+        if self.rx_view:
+            topic = mv[t0:t1]
+            msg = mv[a:b]
+        else:
+            if topic is None:
+                topic = bytes(mv[t0:t1])
+            msg = bytes(mv[a:b])
+        if self.stats is None:
+            for f in hs:
+                f(topic, msg)
+        else:
+            for f in hs:
+                t = ticks_us()
+                f(topic, msg)
+                Stats.hist(self.stats.cb, ticks_diff(ticks_us(), t))
+
+    def _wants(self, topic):
+        return self.cb is not None or self._lvc is not None or bool(self._match(topic))
+
+    # Handlers for topic, found by walking the trie one level at a time, so
+    # the cost grows with topic depth rather than the number of filters.
+    def _match(self, topic):
+        if not self._subs[0]:
+            return None
+        hs = []
+        self._walk(self._subs, topic.split(b"/"), 0, hs)
+        return hs
+
+    def _walk(self, node, levels, k, hs):
+        kids = node[0]
+        # Wildcards never match the first level of a $-topic.
+        wild = k or levels[0][:1] != b"$"
+        if wild and b"#" in kids:
+            hs.extend(kids[b"#"][1])
+        if k == len(levels):
+            hs.extend(node[1])
+            return
+        n = kids.get(levels[k])
+        if n:
+            self._walk(n, levels, k + 1, hs)
+        if wild:
+            n = kids.get(b"+")
+            if n:
+                self._walk(n, levels, k + 1, hs)
+
+    def _node(self, topic, create):
+        if isinstance(topic, str):
+            topic = topic.encode()
+        node = self._subs
+        for level in topic.split(b"/"):
+            n = node[0].get(level)
+            if n is None:
+                if not create:
+                    return None
+                n = node[0][level] = [{}, []]
+            node = n
+        return node
+
+    # Registers f(topic, msg) for messages matching the filter topic, which
+    # may contain + and # wildcards. Messages no handler matches go to the
+    # callback set by set_callback(), or are dropped unread if there is none.
+    def add_handler(self, topic, f):
+        self._node(topic, True)[1].append(f)
+
+    def remove_handler(self, topic, f=None):
+        node = self._node(topic, False)
+        if node:
+            if f is None:
+                node[1].clear()
+            elif f in node[1]:
+                node[1].remove(f)
+
+    def _ack(self, op, pid):
+        pkt = bytearray(b"\0\x02\0\0")
+        pkt[0] = op
+        struct.pack_into("!H", pkt, 2, pid)
+        self._write(pkt)
+        return pkt
 
     def set_callback(self, f):
         self.cb = f
 
+    # Turns transport statistics (see Stats) on or off. While on,
+    # self.stats holds the counters.
+    def set_stats(self, on=True):
+        self.stats = Stats() if on else None
+
+    # Publishes a JSON snapshot of the statistics to topic, e.g.
+    # b"$SYS/clients/<client_id>" on a broker that allows it, and starts
+    # the counters afresh if reset is True. Goes through _post(), which
+    # subclasses keep synchronous, and bypasses any policy on topic.
+    def publish_stats(self, topic, reset=True):
+        import json
+
+        msg = json.dumps(self.stats.snapshot())
+        if reset:
+            self.stats.reset()
+        self._post(topic, msg.encode(), False, 0)
+
+    # Keeps the latest message of up to size topics, so a loop can read the
+    # current state with get_latest() instead of mirroring it from a
+    # callback. Every message received bumps self.seq and is stamped with
+    # it; once full, the topic updated least recently is forgotten.
+    # Callbacks are optional while the cache is on. Publishes streamed to
+    # a chunk callback are not cached.
+    def set_cache(self, size=16):
+        self._lvc = {}
+        self.cache_size = size
+
+    def _remember(self, topic, msg):
+        c = self._lvc
+        self.seq += 1
+        e = c.get(topic)
+        if e is None:
+            if len(c) >= self.cache_size:
+                del c[min(c, key=lambda k: c[k][0])]
+            c[topic] = [self.seq, msg]
+        else:
+            e[0] = self.seq
+            e[1] = msg
+
+    # Returns (seq, msg) for the latest message on topic if it arrived
+    # after seq since, else None. Does not touch the socket.
+    def get_latest(self, topic, since=0):
+        if isinstance(topic, str):
+            topic = topic.encode()
+        e = self._lvc.get(topic)
+        if e is not None and e[0] > since:
+            return e[0], e[1]
+        return None
+
+    # Topics (as bytes) with a message newer than seq since.
+    def changed_since(self, since):
+        return [t for t, e in self._lvc.items() if e[0] > since]
+
+    # Publishes too large for the receive buffer (rbuf_size) are passed to
+    # f(topic, chunk, offset, total) as they arrive instead of growing the
+    # buffer to hold them. chunk is a memoryview into the receive buffer,
+    # valid only during the call; the last piece has offset + len(chunk)
+    # == total. Smaller publishes still go to the normal callbacks. QoS 1
+    # and 2 publishes are acknowledged when their first piece arrives.
+    def set_chunk_callback(self, f):
+        self.chunk_cb = f
+
     def set_last_will(self, topic, msg, retain=False, qos=0):
         assert 0 <= qos <= 2
         assert topic
@@ -59,154 +693,686 @@ class MQTTClient:
         self.lw_msg = msg
         self.lw_qos = qos
         self.lw_retain = retain
+        self._cpkt.clear()
 
-    def connect(self, clean_session=True):
-        self.sock = socket.socket()
-        addr = socket.getaddrinfo(self.server, self.port)[0][-1]
-        self.sock.connect(addr)
+    # Makes the client survive a lost connection. check_msg() and publish()
+    # stop raising OSError: the socket is dropped and check_msg() retries
+    # the connection with exponential backoff between min_ms and max_ms,
+    # resuming the session with clean_session=False. Subscriptions are
+    # replayed if the broker did not keep them. Up to queue publishes made
+    # while offline are kept (policy "drop_oldest" or "drop_newest" once
+    # full) and sent in one burst after reconnecting. Under MQTT 5 the
+    # broker is asked to keep the session for session_expiry seconds.
+    def set_reconnect(
+        self, queue=16, policy="drop_oldest", min_ms=500, max_ms=30000, session_expiry=3600
+    ):
+        assert policy in ("drop_oldest", "drop_newest")
+        self._auto = True
+        # MQTT 5 ends the session on disconnect unless asked to keep it.
+        self.session_expiry = session_expiry
+        self._cpkt.clear()
+        self.queue_len = queue
+        self.queue_policy = policy
+        self._min_delay = min_ms
+        self._max_delay = max_ms
+        self._delay = min_ms
+        self._last_try = ticks_ms() - min_ms
+
+    def _lost(self):
+        if not self._auto:
+            return False
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+        self._clen = 0
+        return True
+
+    # The link can drop again while the session is being restored, so
+    # everything up to the offline queue counts as one attempt: on failure
+    # the pending requests are kept for the next one and the backoff grows.
+    def _try_reconnect(self):
+        self._last_try = ticks_ms()
+        pending = self._subreq
+        moved = {}
+        try:
+            if not self.connect(False) and self._topics:
+                self._resub = True
+            if self._resub:
+                self.subscribe_many(list(self._topics.items()))
+                self._resub = False
+            # (UN)SUBSCRIBEs still waiting for their acknowledgement go out
+            # again under new ids, which wait_suback() follows.
+            for pid, req in pending.items():
+                moved[pid] = self._send_sub(*req)
+        except (OSError, MQTTException):
+            self._subreq = pending
+            self._lost()
+            self._delay = min(self._delay * 2, self._max_delay)
+            return False
+        self._delay = self._min_delay
+        self._moved.update(moved)
+        q = self._offline
+        self._offline = []
+        for m in q:
+            self._post(*m)
+        return True
+
+    # Blocks until the connection is back, sleeping with backoff between
+    # attempts.
+    def reconnect(self):
+        while not self._try_reconnect():
+            time.sleep(self._delay / 1000)
+
+    def _queue_offline(self, topic, msg, retain, qos):
+        if len(self._offline) >= self.queue_len:
+            self.dropped += 1
+            if self.queue_policy == "drop_newest":
+                return
+            self._offline.pop(0)
+        self._offline.append((topic, bytes(msg), retain, qos))
+
+    # Brokers to try, in order, when server/port cannot be reached. Each
+    # entry is a host name or a (host, port) pair. The one that last worked
+    # is tried first on the next connect().
+    def set_fallbacks(self, servers):
+        self._servers = [s if isinstance(s, tuple) else (s, self.port) for s in servers]
+        self._good = 0
+
+    # Address for host, from the cache while it is younger than dns_ttl_ms.
+    # If a lookup fails, an expired entry is still better than nothing.
+    def _resolve(self, host, port):
+        now = ticks_ms()
+        e = self._dns.get((host, port))
+        if e is None or ticks_diff(now, e[1]) >= self.dns_ttl_ms:
+            try:
+                e = (socket.getaddrinfo(host, port)[0][-1], now)
+            except OSError:
+                if e is None:
+                    raise
+            self._dns[(host, port)] = e
+        return e[0]
+
+    def _open(self, host, port):
+        sock = socket.socket()
+        try:
+            sock.connect(self._resolve(host, port))
+        except OSError:
+            sock.close()
+            # The broker may have moved; look it up again next time.
+            self._dns.pop((host, port), None)
+            raise
         if self.ssl:
-            self.sock = self.ssl.wrap_socket(self.sock, server_hostname=self.server)
-        premsg = bytearray(b"\x10\0\0\0\0\0")
-        msg = bytearray(b"\x04MQTT\x04\x02\0\0")
+            sock = self.ssl.wrap_socket(sock, server_hostname=host)
+        self.sock = sock
 
+    def connect(self, clean_session=True):
+        t0 = ticks_ms()
+        servers = [(self.server, self.port)] + self._servers
+        for n in range(len(servers)):
+            k = (self._good + n) % len(servers)
+            try:
+                self._open(*servers[k])
+                break
+            except OSError:
+                if n == len(servers) - 1:
+                    raise
+        self._good = k
+        self.sock.setblocking(False)
+        self._poller = select.poll()
+        self._poller.register(self.sock, select.POLLIN)
+        self._send_connect(clean_session)
+        while self._connack is None:
+            self._poller.poll(-1)
+            self._fill()
+            # Stop at CONNACK; anything queued behind it waits for the
+            # caller to set a callback and poll.
+            self._parse(True)
+        self.connect_ms = ticks_diff(ticks_ms(), t0)
+        if self.stats is not None:
+            self.stats.connect_ms = self.connect_ms
+        return self._connected()
+
+    def _send_connect(self, clean_session):
+        # Anything still coalesced belongs to the old connection.
+        self._clen = 0
+        pkt = self._cpkt.get(clean_session)
+        if pkt is None:
+            pkt = self._cpkt[clean_session] = self._build_connect(clean_session)
+        self._write(pkt)
+        self.flush()
+        self._rpos = self._rlen = self._skip = 0
+        self._sink = None
+        self._connack = None
+        self._subacks.clear()
+        self._subreq = {}
+        self._last_rx = ticks_ms()
+        self._ping_sent = None
+        self.topic_alias_max = 0
+        self._aliases.clear()
+        self._hot.clear()
+
+    # The CONNECT packet is built once and reused by every reconnect.
+    # set_last_will() and set_reconnect() discard it; after changing
+    # client_id, user, pswd or keepalive, call self._cpkt.clear().
+    def _build_connect(self, clean_session):
+        v5 = self.protocol == 5
         sz = 10 + 2 + len(self.client_id)
-        msg[6] = clean_session << 1
         if self.user:
             sz += 2 + len(self.user) + 2 + len(self.pswd)
-            msg[6] |= 0xC0
+        if self.lw_topic:
+            sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
+        if v5:
+            # Empty property lists, plus Session Expiry Interval when the
+            # session should outlive the connection.
+            sz += 1 + (5 if self.session_expiry else 0) + (1 if self.lw_topic else 0)
+        buf = self._wreserve(sz + 5)
+        buf[0] = 0x10
+        i = self._put_len(1, sz)
+        buf[i : i + 10] = b"\0\x04MQTT\x04\x02\0\0"
+        buf[i + 6] = self.protocol
+        flags = clean_session << 1
+        if self.user:
+            flags |= 0xC0
         if self.keepalive:
             assert self.keepalive < 65536
-            msg[7] |= self.keepalive >> 8
-            msg[8] |= self.keepalive & 0x00FF
+            struct.pack_into("!H", buf, i + 8, self.keepalive)
         if self.lw_topic:
-            sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
-            msg[6] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
-            msg[6] |= self.lw_retain << 5
-
-        i = 1
-        while sz > 0x7F:
-            premsg[i] = (sz & 0x7F) | 0x80
-            sz >>= 7
+            flags |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
+            flags |= self.lw_retain << 5
+        buf[i + 7] = flags
+        i += 10
+        if v5:
+            if self.session_expiry:
+                buf[i : i + 2] = b"\x05\x11"
+                struct.pack_into("!I", buf, i + 2, self.session_expiry)
+                i += 5
+            else:
+                buf[i] = 0
             i += 1
-        premsg[i] = sz
-
-        self.sock.write(premsg, i + 2)
-        self.sock.write(msg)
-        # print(hex(len(msg)), hexlify(msg, ":"))
-        self._send_str(self.client_id)
+        i = self._put_str(i, self.client_id)
         if self.lw_topic:
-            self._send_str(self.lw_topic)
-            self._send_str(self.lw_msg)
+            if v5:
+                buf[i] = 0
+                i += 1
+            i = self._put_str(i, self.lw_topic)
+            i = self._put_str(i, self.lw_msg)
         if self.user:
-            self._send_str(self.user)
-            self._send_str(self.pswd)
-        resp = self.sock.read(4)
-        assert resp[0] == 0x20 and resp[1] == 0x02
-        if resp[3] != 0:
-            raise MQTTException(resp[3])
-        return resp[2] & 1
+            i = self._put_str(i, self.user)
+            i = self._put_str(i, self.pswd)
+        # print(hex(i), hexlify(self._wmv[:i], ":"))
+        return bytes(self._wmv[:i])
+
+    def _connected(self):
+        if self._connack[1] != 0:
+            raise MQTTException(self._connack[1])
+        if not self._connack[0] & 1:
+            # New session: QoS 2 ids the old one never released may be
+            # reused for new messages.
+            self._rx_pids.clear()
+        # Publishes not acknowledged on the previous connection go out again.
+        for e in self._inflight.values():
+            self._resend(e)
+        return self._connack[0] & 1
 
     def disconnect(self):
-        self.sock.write(b"\xe0\0")
+        self._write(b"\xe0\0")
+        self.flush()
         self.sock.close()
 
     def ping(self):
-        self.sock.write(b"\xc0\0")
+        self._write(b"\xc0\0")
 
-    def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
-        sz = 2 + len(topic) + len(msg)
+    # Offset in the outgoing buffer at which the payload of a PUBLISH to
+    # topic starts. The fixed header, topic and packet id are laid out
+    # right before it, so header and payload leave in one write.
+    def _payload_off(self, topic, qos):
+        return 5 + 2 + len(topic) + (2 if qos else 0) + (4 if self.protocol == 5 else 0)
+
+    # Writes the PUBLISH header for an n byte payload so that it ends at
+    # off. Returns the start offset and the packet id (0 for QoS 0).
+    def _pub_header(self, topic, n, retain, qos, off):
+        alias = 0
+        # Aliases belong to one connection, and QoS 1/2 packets are kept to
+        # be resent on the next one, so only QoS 0 publishes use them.
+        if self.topic_alias_max and not qos:
+            alias = self._alias(topic)
+            if alias > 0:
+                # Topic already bound to the alias on this connection: send
+                # only the 2-byte alias.
+                topic = b""
+            alias = abs(alias)
+        sz = 2 + len(topic) + n
         if qos > 0:
             sz += 2
-        assert sz < 2097152
-        i = 1
-        while sz > 0x7F:
-            pkt[i] = (sz & 0x7F) | 0x80
-            sz >>= 7
-            i += 1
-        pkt[i] = sz
-        # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
+        if self.protocol == 5:
+            sz += 4 if alias else 1
+        assert sz <= 268435455  # protocol limit
+        h = 1
+        while sz >> (7 * h):
+            h += 1
+        start = off - (h + 1 + sz - n)
+        buf = self._wbuf
+        buf[start] = 0x30 | qos << 1 | retain
+        i = self._put_str(self._put_len(start + 1, sz), topic)
+        pid = 0
         if qos > 0:
-            self.pid += 1
-            pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
-        if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
-        elif qos == 2:
-            assert 0
-
-    def subscribe(self, topic, qos=0):
-        assert self.cb is not None, "Subscribe callback is not set"
-        pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
-        # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt)
-        self._send_str(topic)
-        self.sock.write(qos.to_bytes(1, "little"))
-        while 1:
-            op = self.wait_msg()
-            if op == 0x90:
-                resp = self.sock.read(4)
-                # print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
+            pid = self._new_pid()
+            struct.pack_into("!H", buf, i, pid)
+            i += 2
+        if self.protocol == 5:
+            if alias:
+                buf[i] = 3
+                buf[i + 1] = 0x23
+                struct.pack_into("!H", buf, i + 2, alias)
+            else:
+                buf[i] = 0
+        return start, pid
+
+    # MQTT 5 topic alias for topic. A topic gets an alias the second time it
+    # is published, while the broker's Topic Alias Maximum allows, so
+    # one-off topics do not use up aliases. Returns the alias if the broker
+    # already knows it, its negation if this publish must carry the topic
+    # to bind it, or 0.
+    def _alias(self, topic):
+        a = self._aliases.get(topic)
+        if a:
+            return a
+        if len(self._aliases) >= self.topic_alias_max:
+            return 0
+        if topic not in self._hot:
+            if len(self._hot) >= 32:
+                self._hot.clear()
+            self._hot.add(topic)
+            return 0
+        self._hot.discard(topic)
+        a = len(self._aliases) + 1
+        self._aliases[topic] = a
+        return -a
+
+    # Returns a memoryview into the outgoing buffer where a payload for
+    # publish_into(topic, ...) can be written in place. Reusing it every
+    # frame avoids allocating a new message object per publish.
+    def payload_buf(self, topic, qos=0):
+        if qos:
+            self._wait_window()
+        return self._wmv[self._payload_off(topic, qos) :]
+
+    # Publishes the first n bytes previously written to payload_buf(topic).
+    # topic and qos must be the same as given to payload_buf().
+    def publish_into(self, topic, n, retain=False, qos=0):
+        if self._policy:
+            off = self._payload_off(topic, qos)
+            if not self._allow(topic, self._wmv[off : off + n], retain, qos):
                 return
+        self._post_into(topic, n, retain, qos)
+
+    def _post_into(self, topic, n, retain, qos):
+        off = self._payload_off(topic, qos)
+        assert off + n <= len(self._wbuf)
+        if self.sock is None and self._auto:
+            return self._queue_offline(topic, self._wmv[off : off + n], retain, qos)
+        try:
+            if qos:
+                self._wait_window()
+            start, pid = self._pub_header(topic, n, retain, qos, off)
+            self._send(start, off + n)
+        except OSError:
+            if not self._lost():
+                raise
+            return self._queue_offline(topic, self._wmv[off : off + n], retain, qos)
+        if qos:
+            self._track(pid, self._wmv[start : off + n])
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        if isinstance(msg, str):
+            msg = msg.encode()
+        if self._policy and not self._allow(topic, msg, retain, qos):
+            return
+        self._post(topic, msg, retain, qos)
+
+    # publish() without the topic policy.
+    def _post(self, topic, msg, retain, qos):
+        if self.sock is None and self._auto:
+            return self._queue_offline(topic, msg, retain, qos)
+        try:
+            self._publish(topic, msg, retain, qos)
+        except OSError:
+            if not self._lost():
+                raise
+            self._queue_offline(topic, msg, retain, qos)
+
+    def _publish(self, topic, msg, retain, qos):
+        if qos:
+            self._wait_window()
+        off = self._payload_off(topic, qos)
+        n = len(msg)
+        if off + n <= len(self._wbuf):
+            self._wbuf[off : off + n] = msg
+            return self._post_into(topic, n, retain, qos)
+        # Payload larger than the buffer: header in one write, payload in
+        # another rather than copying it.
+        self._wreserve(off)
+        start, pid = self._pub_header(topic, n, retain, qos, off)
+        self._send(start, off)
+        self._write(msg, True)
+        if qos:
+            self._track(pid, bytearray(self._wmv[start:off]) + msg)
+
+    # Sets the publish policy for topic (as passed to publish()):
+    #   min_ms - publishes closer than this to the previous one are dropped,
+    #   dedup  - a payload equal to the last one sent is dropped,
+    #   latest - instead of dropping a publish held back by min_ms, keep it
+    #            and send it once the interval has passed; a newer publish
+    #            replaces it.
+    # Held publishes go out from check_msg()/wait_msg(). Calling with only
+    # the topic removes its policy.
+    def set_policy(self, topic, min_ms=0, dedup=False, latest=False):
+        if min_ms or dedup:
+            # [min_ms, dedup, latest, last sent ticks, last payload, held]
+            self._policy[topic] = [min_ms, dedup, latest, None, None, None]
+        else:
+            self._policy.pop(topic, None)
+
+    # Applies the policy for topic and returns True if msg should go out now.
+    def _allow(self, topic, msg, retain, qos):
+        p = self._policy.get(topic)
+        if p is None:
+            return True
+        last = p[4]
+        if p[1] and last is not None and len(last) == len(msg) and last == bytes(msg):
+            # Subscribers already have this value; a held older one is stale.
+            p[5] = None
+            return False
+        now = ticks_ms()
+        if p[3] is not None and ticks_diff(now, p[3]) < p[0]:
+            if p[2]:
+                p[5] = (bytes(msg), retain, qos)
+            return False
+        p[3] = now
+        p[5] = None
+        if p[1]:
+            p[4] = bytes(msg)
+        return True
 
-    # Wait for a single incoming MQTT message and process it.
-    # Subscribed messages are delivered to a callback previously
+    # Sends held publishes whose min_ms interval has passed.
+    def _release(self):
+        now = ticks_ms()
+        for topic, p in self._policy.items():
+            if p[5] is not None and ticks_diff(now, p[3]) >= p[0]:
+                msg, retain, qos = p[5]
+                p[3] = now
+                p[5] = None
+                if p[1]:
+                    p[4] = msg
+                self._post(topic, msg, retain, qos)
+
+    # Publishes n bytes read from src without holding them all in memory.
+    # src is a file-like object (readinto() or read()) or an iterable of
+    # bytes-like chunks; file-like sources are read through the send buffer,
+    # wbuf_size bytes at a time. QoS 0 only, since a QoS 1/2 publish would
+    # have to be kept for retransmission. If src ends before n bytes the
+    # packet cannot be completed, so the connection is closed and OSError
+    # raised.
+    def publish_stream(self, topic, src, n, retain=False):
+        if self.sock is None:
+            raise OSError(-1)
+        for _ in self._stream(topic, src, n, retain):
+            pass
+
+    # Writes the publish, yielding after each chunk.
+    def _stream(self, topic, src, n, retain):
+        off = self._payload_off(topic, 0)
+        self._wreserve(off)
+        start, _ = self._pub_header(topic, n, retain, 0, off)
+        self._send(start, off)
+        mv = self._wmv
+        it = None if hasattr(src, "read") else iter(src)
+        while n:
+            if it is not None:
+                data = next(it, b"")
+            elif hasattr(src, "readinto"):
+                data = mv[: src.readinto(mv[: min(n, len(mv))]) or 0]
+            else:
+                data = src.read(min(n, len(mv)))
+            if not data or len(data) > n:
+                self._abort()
+                raise OSError(errno.EIO)
+            self._write(data, True)
+            n -= len(data)
+            yield
+
+    def _abort(self):
+        if not self._lost():
+            self.sock.close()
+
+    # QoS 1 and 2 publishes do not wait for their acknowledgements. Up to
+    # max_inflight of them may be outstanding; a publish beyond that blocks
+    # until a PUBACK or PUBCOMP frees a slot.
+    def _wait_window(self):
+        while len(self._inflight) >= self.max_inflight:
+            self.wait_msg()
+
+    def _track(self, pid, pkt):
+        self._inflight[pid] = [bytearray(pkt), ticks_ms()]
+
+    def _resend(self, e):
+        if e[0][0] & 0xF0 == 0x30:
+            e[0][0] |= 0x08  # DUP
+        self._write(e[0])
+        e[1] = ticks_ms()
+
+    # Unacknowledged publishes go out again after retry_ms. MQTT 5 forbids
+    # that, leaving resends to the next connection (see _connected()).
+    def _retry(self):
+        if self._inflight and self.protocol == 4:
+            now = ticks_ms()
+            for e in self._inflight.values():
+                if ticks_diff(now, e[1]) >= self.retry_ms:
+                    self._resend(e)
+
+    # Keepalive scheduler. A PINGREQ goes out after keepalive/2 seconds
+    # without an outbound packet, or without an inbound one, so only links
+    # busy both ways never ping and a client that just publishes QoS 0
+    # still notices a dead broker. If nothing comes back within another
+    # keepalive/2 the link is reported dead with OSError(ETIMEDOUT), i.e.
+    # within one keepalive period of the last traffic. The PINGREQ is
+    # written directly: subclasses may make ping() a coroutine.
+    def _keepalive(self):
+        if not self.keepalive:
+            return
+        now = ticks_ms()
+        half = self.keepalive * 500
+        if self._ping_sent is not None:
+            if ticks_diff(now, self._ping_sent) >= half:
+                raise OSError(errno.ETIMEDOUT)
+        elif ticks_diff(now, self._last_tx) >= half or ticks_diff(now, self._last_rx) >= half:
+            self._write(b"\xc0\0")
+            self._ping_sent = now
+
+    # Housekeeping run on every poll of the socket.
+    def _service(self):
+        self._retry()
+        self._keepalive()
+        if self._policy:
+            self._release()
+        self.flush()
+
+    # Milliseconds until _service() has work: a ping or its deadline, a
+    # retry, a held publish or coalesced bytes to flush. -1 if none.
+    def _due(self):
+        now = ticks_ms()
+        ts = []
+        if self.keepalive:
+            half = self.keepalive * 500
+            if self._ping_sent is not None:
+                ts.append(half - ticks_diff(now, self._ping_sent))
+            else:
+                ts.append(half - max(ticks_diff(now, self._last_tx), ticks_diff(now, self._last_rx)))
+        if self.protocol == 4:
+            for e in self._inflight.values():
+                ts.append(self.retry_ms - ticks_diff(now, e[1]))
+        for p in self._policy.values():
+            if p[5] is not None:
+                ts.append(p[0] - ticks_diff(now, p[3]))
+        if self._clen:
+            ts.append(self.latency_ms - ticks_diff(now, self._cfirst))
+        return max(0, min(ts)) if ts else -1
+
+    # Waits up to timeout_ms (-1 for no limit) for the socket to become
+    # readable and returns whether it did. Housekeeping that falls due in
+    # the meantime is done on the way, so a long wait neither lets the
+    # broker drop an idle client nor misses a dead broker.
+    def _readable(self, timeout_ms):
+        t0 = ticks_ms()
+        while 1:
+            wait = self._due()
+            if timeout_ms >= 0:
+                left = max(0, timeout_ms - ticks_diff(ticks_ms(), t0))
+                if wait < 0 or left <= wait:
+                    return bool(self._poller.poll(left))
+            if self._poller.poll(wait):
+                return True
+            self._service()
+
+    # Blocks until at most n QoS 1/2 publishes are waiting for their
+    # acknowledgement.
+    def wait_inflight(self, n=0):
+        while len(self._inflight) > n:
+            self.wait_msg()
+
+    def subscribe(self, topic, qos=0, cb=None):
+        codes = self.wait_suback(self.subscribe_many(((topic, qos, cb),)))
+        if codes[0] >= 0x80:
+            raise MQTTException(codes[0])
+
+    # Subscribes to several (topic, qos) or (topic, qos, cb) filters with a
+    # single SUBSCRIBE packet. Returns its packet id without waiting: the
+    # SUBACK is recorded when it arrives and can be collected with
+    # wait_suback(pid).
+    def subscribe_many(self, topics):
+        sz = 3 if self.protocol == 5 else 2
+        for t in topics:
+            sz += 2 + len(t[0]) + 1
+            self._topics[t[0]] = t[1]
+            if len(t) > 2 and t[2]:
+                self.add_handler(t[0], t[2])
+        assert (
+            self.cb is not None or self._subs[0] or self._lvc is not None
+        ), "Subscribe callback is not set"
+        return self._send_sub(0x82, topics, sz)
+
+    # Unsubscribes from one topic or a list of them with a single packet and
+    # drops their handlers. Returns the packet id, like subscribe_many().
+    def unsubscribe(self, topics):
+        if isinstance(topics, (str, bytes)):
+            topics = (topics,)
+        sz = 3 if self.protocol == 5 else 2
+        for t in topics:
+            sz += 2 + len(t)
+            self._topics.pop(t, None)
+            self.remove_handler(t)
+        return self._send_sub(0xA2, topics, sz)
+
+    def _send_sub(self, op, topics, sz):
+        pid = self._new_pid()
+        self._subacks[pid] = None
+        self._subreq[pid] = (op, topics, sz)
+        buf = self._wreserve(sz + 5)
+        buf[0] = op
+        i = self._put_len(1, sz)
+        struct.pack_into("!H", buf, i, pid)
+        i += 2
+        if self.protocol == 5:
+            buf[i] = 0
+            i += 1
+        for t in topics:
+            if op == 0xA2:
+                i = self._put_str(i, t)
+            else:
+                i = self._put_str(i, t[0])
+                buf[i] = t[1]
+                i += 1
+        # print(hex(i), hexlify(self._wmv[:i], ":"))
+        self._send(0, i)
+        if self.stats is not None:
+            self.stats._sent[pid] = ticks_ms()
+        return pid
+
+    # Blocks until the SUBACK (or UNSUBACK) for pid has arrived and returns
+    # its return codes, one per topic (0x80 marks a rejected filter). With
+    # set_reconnect() a request cut off by a reconnect is sent again and
+    # waited for under its new id; otherwise OSError is raised.
+    def wait_suback(self, pid):
+        while 1:
+            while pid in self._moved:
+                pid = self._moved.pop(pid)
+            if pid not in self._subacks and pid not in self._subreq:
+                raise OSError(-1)
+            if self._subacks.get(pid) is not None:
+                return self._subacks.pop(pid)
+            self.wait_msg()
+
+    # Wait for incoming MQTT messages and process them. The socket is
+    # read in one go and every complete packet in the receive buffer is
+    # handled. Subscribed messages are delivered to a callback previously
     # set by .set_callback() method. Other (internal) MQTT
     # messages processed internally.
     def wait_msg(self):
-        res = self.sock.read(1)
-        self.sock.setblocking(True)
-        if res is None:
-            return None
-        if res == b"":
-            raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self.sock.read(1)[0]
-            assert sz == 0
+        if self.sock is None and self._auto:
+            self.reconnect()
+        try:
+            self.flush()
+            op = self._parse()
+            while op is None:
+                self._readable(-1)
+                self._fill()
+                op = self._parse()
+            self._service()
+        except OSError:
+            if not self._lost():
+                raise
+            self.reconnect()
             return None
-        op = res[0]
-        if op & 0xF0 != 0x30:
-            return op
-        sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
-        sz -= topic_len + 2
-        if op & 6:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self.sock.read(sz)
-        self.cb(topic, msg)
-        if op & 6 == 2:
-            pkt = bytearray(b"\x40\x02\0\0")
-            struct.pack_into("!H", pkt, 2, pid)
-            self.sock.write(pkt)
-        elif op & 6 == 4:
-            assert 0
         return op
 
     # Checks whether a pending message from server is available.
     # If not, returns immediately with None. Otherwise, does
     # the same processing as wait_msg.
     def check_msg(self):
-        self.sock.setblocking(False)
-        return self.wait_msg()
+        return self.poll(0)
+
+    # Waits up to timeout_ms (-1 for no limit) for a complete packet, then
+    # handles every complete packet received so far and returns the type of
+    # the last one, or None. Each read takes only the bytes that have
+    # arrived, so poll(0) never blocks. The socket stays non-blocking, so
+    # polling costs no socket option calls; to wait on other streams as
+    # well, register client.sock with your own poller and call poll(0) when
+    # it is readable.
+    def poll(self, timeout_ms=0):
+        if self.sock is None and self._auto:
+            if ticks_diff(ticks_ms(), self._last_try) >= self._delay:
+                self._try_reconnect()
+            return None
+        try:
+            op = self._parse()
+            t0 = ticks_ms()
+            wait = 0 if op else timeout_ms
+            while self._readable(wait):
+                self._fill()
+                op = self._parse() or op
+                if op is not None:
+                    break
+                # Only part of a packet so far; wait out the rest of the time.
+                if timeout_ms > 0:
+                    wait = max(0, timeout_ms - ticks_diff(ticks_ms(), t0))
+            if op is None and self.stats is not None:
+                self.stats.empty_polls += 1
+            self._service()
+        except OSError:
+            if not self._lost():
+                raise
+            return None
+        return op
@@ -0,0 +1,338 @@
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+from mqtt import MQTTClient, MQTTException, ticks_diff, ticks_ms
+
+
+# MQTTClient driven by asyncio streams instead of check_msg() polling.
+# A reader task parses packets the moment bytes arrive, so subscribed
+# messages reach the callback (or the async iterator) without a poll
+# interval. connect, publish, subscribe and disconnect are awaitable; the
+# rest of the protocol handling (buffers, in-flight table, QoS 2) is
+# shared with MQTTClient. Works with CPython asyncio and uasyncio.
+#
+# One client can serve any number of tasks: each packet is written whole,
+# drains are serialized, and handle() gives a task its own subscriptions
+# and message queue over the shared connection.
+class AsyncMQTTClient(MQTTClient):
+    def __init__(self, *args, queue_len=8, **kw):
+        super().__init__(*args, **kw)
+        self._reader = None
+        self._writer = None
+        self._tasks = ()
+        self._evt = asyncio.Event()
+        # Messages waiting for `async for` when no callback is set.
+        self._queue = []
+        self.queue_len = queue_len
+        self.cb = self._enqueue
+        self._flushing = False
+        # Held by whoever is writing to the stream; uasyncio allows only one
+        # task waiting to write it. While publish_stream() owns the wire,
+        # packets from other tasks (and acks from the reader) queue in
+        # _held.
+        self._wlock = asyncio.Lock()
+        self._held = None
+        self._handles = []
+
+    def _out(self, data):
+        if self._writer is None:
+            raise OSError(-1)
+        self._writer.write(bytes(data))
+
+    def _write(self, data, more=False):
+        if self._held is not None:
+            self._held.append((bytes(data), more))
+        else:
+            super()._write(data, more)
+
+    async def _drain(self):
+        async with self._wlock:
+            if self._writer is None:
+                raise OSError(-1)
+            await self._writer.drain()
+
+    # QoS windows are awaited in publish() before the packet is built.
+    def _wait_window(self):
+        pass
+
+    def _enqueue(self, topic, msg):
+        if len(self._queue) >= self.queue_len:
+            self._queue.pop(0)
+        self._queue.append((bytes(topic), bytes(msg)))
+
+    async def _wait(self):
+        if self._clen:
+            self.flush()
+            await self._drain()
+        self._evt.clear()
+        await self._evt.wait()
+        if self._reader is None:
+            raise OSError(-1)
+
+    async def _read(self):
+        self._compact()
+        data = await self._reader.read(len(self._rbuf) - self._rlen)
+        if not data:
+            raise OSError(-1)
+        n = len(data)
+        self._rbuf[self._rlen : self._rlen + n] = data
+        self._rlen += n
+        self._last_rx = ticks_ms()
+        self._ping_sent = None
+
+    async def _run(self):
+        try:
+            while 1:
+                self._parse()
+                self._evt.set()
+                await self._drain()
+                await self._read()
+        except (OSError, MQTTException):
+            self._close()
+        except Exception:
+            # Closed either way, so nothing waits on a dead reader.
+            self._close()
+            raise
+
+    # Handlers run in the reader task, where an exception would stop all
+    # reading. It is printed instead and the packet handled as usual, so a
+    # QoS 1/2 message is still acknowledged.
+    def _deliver(self, t0, t1, a, b):
+        try:
+            super()._deliver(t0, t1, a, b)
+        except Exception as e:
+            print("mqtt: handler raised", repr(e))
+
+    def _chunk(self, a, n):
+        try:
+            super()._chunk(a, n)
+        except Exception as e:
+            self._sink = None
+            print("mqtt: chunk callback raised", repr(e))
+
+    # Retries and keepalive pings; a dead link closes the connection.
+    async def _tick(self):
+        try:
+            while 1:
+                await asyncio.sleep(1)
+                self._service()
+                await self._drain()
+        except OSError:
+            self._close()
+
+    def _close(self):
+        for t in self._tasks:
+            if t is not asyncio.current_task():
+                t.cancel()
+        self._tasks = ()
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+        self._evt.set()
+        for h in self._handles:
+            h._evt.set()
+
+    # Host names are resolved by open_connection(), so only the fallback
+    # list and connect_ms apply here, not the DNS cache.
+    async def connect(self, clean_session=True):
+        t0 = ticks_ms()
+        kw = {"ssl": self.ssl} if self.ssl else {}
+        servers = [(self.server, self.port)] + self._servers
+        for n in range(len(servers)):
+            k = (self._good + n) % len(servers)
+            try:
+                self._reader, self._writer = await asyncio.open_connection(*servers[k], **kw)
+                break
+            except OSError:
+                if n == len(servers) - 1:
+                    raise
+        self._good = k
+        self._send_connect(clean_session)
+        await self._drain()
+        while self._connack is None:
+            await self._read()
+            # Stop at CONNACK; the reader task handles what follows it.
+            self._parse(True)
+        self.connect_ms = ticks_diff(ticks_ms(), t0)
+        if self.stats is not None:
+            self.stats.connect_ms = self.connect_ms
+        present = self._connected()
+        self._tasks = (asyncio.create_task(self._run()), asyncio.create_task(self._tick()))
+        return present
+
+    async def disconnect(self):
+        if self._writer is not None:
+            self._write(b"\xe0\0")
+            self.flush()
+            await self._drain()
+            writer = self._writer
+            self._close()
+            await writer.wait_closed()
+
+    async def ping(self):
+        self._write(b"\xc0\0")
+        self.flush()
+        await self._drain()
+
+    async def publish(self, topic, msg, retain=False, qos=0):
+        if qos:
+            while len(self._inflight) >= self.max_inflight:
+                await self._wait()
+        super().publish(topic, msg, retain, qos)
+        if self._cbuf is None:
+            await self._drain()
+        elif self._clen and not self._flushing:
+            self._flushing = True
+            asyncio.create_task(self._flush_soon())
+
+    async def publish_stats(self, topic, reset=True):
+        super().publish_stats(topic, reset)
+        self.flush()
+        await self._drain()
+
+    # With set_coalesce(), publishes made by any task during one pass of
+    # the event loop leave together on the next pass.
+    async def _flush_soon(self):
+        await asyncio.sleep(0)
+        self._flushing = False
+        if self._writer is not None:
+            self.flush()
+            await self._drain()
+
+    # Drains the writer after every chunk, so at most one chunk is buffered.
+    # Other packets written meanwhile go out after the stream.
+    async def publish_stream(self, topic, src, n, retain=False):
+        async with self._wlock:
+            held = []
+            g = self._stream(topic, src, n, retain)
+            try:
+                while 1:
+                    self._held = None
+                    try:
+                        next(g)
+                    except StopIteration:
+                        break
+                    finally:
+                        self.flush()
+                        self._held = held
+                    await self._writer.drain()
+            finally:
+                self._held = None
+                if self._writer is not None:
+                    for d in held:
+                        self._write(*d)
+                    self.flush()
+                    await self._writer.drain()
+
+    def _abort(self):
+        self._close()
+
+    # There is no poll loop here to reconnect from, so publishes would sit
+    # in the offline queue for good. When the connection drops, calls
+    # raise OSError and iterators end; connect(False) resumes the session.
+    def set_reconnect(self, *args, **kw):
+        raise NotImplementedError("reconnect with connect(False)")
+
+    async def subscribe(self, topic, qos=0, cb=None):
+        codes = await self.wait_suback(await self.subscribe_many(((topic, qos, cb),)))
+        if codes[0] >= 0x80:
+            raise MQTTException(codes[0])
+
+    async def subscribe_many(self, topics):
+        pid = super().subscribe_many(topics)
+        self.flush()
+        await self._drain()
+        return pid
+
+    async def unsubscribe(self, topics):
+        pid = super().unsubscribe(topics)
+        self.flush()
+        await self._drain()
+        return pid
+
+    async def wait_suback(self, pid):
+        while self._subacks.get(pid) is None:
+            await self._wait()
+        return self._subacks.pop(pid)
+
+    async def wait_inflight(self, n=0):
+        while len(self._inflight) > n:
+            await self._wait()
+
+    # A handle on this connection for one task; see MQTTHandle.
+    def handle(self, queue_len=8):
+        h = MQTTHandle(self, queue_len)
+        self._handles.append(h)
+        return h
+
+    # `async for topic, msg in client` yields messages as they arrive when
+    # no callback is set, and stops once the connection is closed.
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._queue:
+            if self._reader is None:
+                raise StopAsyncIteration
+            try:
+                await self._wait()
+            except OSError:
+                raise StopAsyncIteration
+        return self._queue.pop(0)
+
+
+# A task's view of a shared AsyncMQTTClient: publishes go through the
+# client, and messages on the topics subscribed through this handle are
+# queued here (up to queue_len, oldest dropped) rather than in the client.
+# Several handles may subscribe to the same filter; the broker is only
+# told to unsubscribe when the last of them does.
+class MQTTHandle:
+    def __init__(self, client, queue_len):
+        self.client = client
+        self.queue_len = queue_len
+        self._queue = []
+        self._evt = asyncio.Event()
+        self._topics = []
+        self._put = self._enqueue
+
+    def _enqueue(self, topic, msg):
+        if len(self._queue) >= self.queue_len:
+            self._queue.pop(0)
+        self._queue.append((bytes(topic), bytes(msg)))
+        self._evt.set()
+
+    async def publish(self, topic, msg, retain=False, qos=0):
+        await self.client.publish(topic, msg, retain, qos)
+
+    async def subscribe(self, topic, qos=0):
+        self._topics.append(topic)
+        await self.client.subscribe(topic, qos, self._put)
+
+    async def unsubscribe(self, topic):
+        c = self.client
+        self._topics.remove(topic)
+        c.remove_handler(topic, self._put)
+        node = c._node(topic, False)
+        if not (node and node[1]):
+            await c.unsubscribe(topic)
+
+    # Unsubscribes everything subscribed through this handle and ends its
+    # `async for`.
+    async def close(self):
+        for t in self._topics[:]:
+            await self.unsubscribe(t)
+        self.client._handles.remove(self)
+        self._evt.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._queue:
+            if self.client._reader is None or self not in self.client._handles:
+                raise StopAsyncIteration
+            self._evt.clear()
+            await self._evt.wait()
+        return self._queue.pop(0)
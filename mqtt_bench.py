@@ -0,0 +1,245 @@
+import argparse
+import asyncio
+import socket
+import struct
+import threading
+import time
+
+import mqtt
+from mqtt_async import AsyncMQTTClient
+from mqtt_broker import Broker
+
+
+# Load generator and benchmark for MQTTClient (CPython only). N virtual
+# devices publish to bench/<mode>/<n> at a fixed rate while one subscriber
+# timestamps what comes back through the broker. For every client mode
+# it reports delivered messages per second, p50/p99 end-to-end latency
+# and the CPU time the publishing clients used per 1000 messages.
+#
+#   python mqtt_bench.py --devices 10 --rate 100 --seconds 5
+#   python mqtt_bench.py --host broker.local qos0 coalesce
+#
+# Without --host a Broker from mqtt_broker.py runs in a background
+# thread, so the numbers include its cost on the same interpreter.
+
+
+# MicroPython stream semantics over a CPython socket: readinto() on a
+# blocking socket fills the whole buffer (no short reads), on a
+# non-blocking one it returns what is there, or None. write() on a
+# non-blocking socket may likewise take only part of the data.
+class _Sock:
+    def __init__(self, s):
+        self.s = s
+        self.blocking = True
+
+    def readinto(self, buf):
+        if not self.blocking:
+            try:
+                return self.s.recv_into(buf)
+            except BlockingIOError:
+                return None
+        mv = memoryview(buf)
+        n = 0
+        while n < len(mv):
+            k = self.s.recv_into(mv[n:])
+            if not k:
+                break
+            n += k
+        return n
+
+    def write(self, data):
+        if not self.blocking:
+            try:
+                return self.s.send(data)
+            except BlockingIOError:
+                return None
+        self.s.sendall(data)
+        return len(data)
+
+    def setblocking(self, flag):
+        self.blocking = flag
+        self.s.setblocking(flag)
+
+    def fileno(self):
+        return self.s.fileno()
+
+    def close(self):
+        self.s.close()
+
+
+class Client(mqtt.MQTTClient):
+    def _open(self, host, port):
+        s = socket.create_connection((host, port))
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = _Sock(s)
+
+
+# Client modes under test: constructor arguments and a setup function.
+MODES = {
+    "qos0": ({}, None, 0),
+    "qos1": ({}, None, 1),
+    "qos1-window": ({"max_inflight": 16}, None, 1),
+    "qos2-window": ({"max_inflight": 16}, None, 2),
+    "coalesce": ({}, lambda c: c.set_coalesce(), 0),
+    "mqtt5-alias": ({"protocol": 5}, None, 0),
+    "async": ({}, None, 0),
+}
+
+
+def _pct(xs, p):
+    return xs[min(len(xs) - 1, int(len(xs) * p))] if xs else float("nan")
+
+
+def _device(n, host, port, mode, rate, seconds, size, out):
+    kw, setup, qos = MODES[mode]
+    c = Client(b"dev%d" % n, host, port, keepalive=60, **kw)
+    if setup:
+        setup(c)
+    c.connect()
+    topic = b"bench/%s/%d" % (mode.encode(), n)
+    pad = bytes(max(0, size - 8))
+    gap = 1 / rate if rate else 0
+    cpu = time.thread_time()
+    sent = 0
+    start = time.perf_counter()
+    end = start + seconds
+    while 1:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        c.publish(topic, struct.pack("!d", now) + pad, qos=qos)
+        sent += 1
+        c.poll(0)
+        if gap:
+            delay = start + sent * gap - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    c.wait_inflight()
+    c.flush()
+    out.append((sent, time.thread_time() - cpu))
+    c.disconnect()
+
+
+# All devices as tasks of one AsyncMQTTClient event loop.
+def _async_devices(devices, host, port, rate, seconds, size, out):
+    async def device(n):
+        c = AsyncMQTTClient(b"dev%d" % n, host, port, keepalive=60)
+        await c.connect()
+        topic = b"bench/async/%d" % n
+        pad = bytes(max(0, size - 8))
+        gap = 1 / rate if rate else 0
+        sent = 0
+        start = time.perf_counter()
+        while time.perf_counter() < start + seconds:
+            await c.publish(topic, struct.pack("!d", time.perf_counter()) + pad)
+            sent += 1
+            await asyncio.sleep(max(0, start + sent * gap - time.perf_counter()))
+        await c.disconnect()
+        return sent
+
+    async def run():
+        return await asyncio.gather(*(device(n) for n in range(devices)))
+
+    cpu = time.thread_time()
+    sent = asyncio.run(run())
+    out.append((sum(sent), time.thread_time() - cpu))
+
+
+def run(mode, host, port, devices=10, rate=100, seconds=5, size=32):
+    lat = []
+
+    def cb(topic, msg):
+        lat.append(time.perf_counter() - struct.unpack_from("!d", msg)[0])
+
+    sub = Client(b"bench-sub", host, port, keepalive=60, rbuf_size=4096)
+    sub.set_callback(cb)
+    sub.connect()
+    # Per mode, so a broker still working off the previous run does not
+    # leak into this one.
+    sub.subscribe(b"bench/%s/#" % mode.encode())
+    done = threading.Event()
+
+    def listen():
+        while not done.is_set():
+            sub.poll(50)
+
+    listener = threading.Thread(target=listen)
+    listener.start()
+    out = []
+    if mode == "async":
+        threads = [threading.Thread(target=_async_devices, args=(devices, host, port, rate, seconds, size, out))]
+    else:
+        threads = [
+            threading.Thread(target=_device, args=(n, host, port, mode, rate, seconds, size, out))
+            for n in range(devices)
+        ]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    sent = sum(o[0] for o in out)
+    # Let the last messages arrive.
+    deadline = time.perf_counter() + 2
+    while len(lat) < sent and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - t0
+    done.set()
+    listener.join()
+    sub.disconnect()
+    lat.sort()
+    cpu = sum(o[1] for o in out)
+    return {
+        "mode": mode,
+        "sent": sent,
+        "received": len(lat),
+        "msg_s": len(lat) / elapsed,
+        "p50_ms": _pct(lat, 0.5) * 1000,
+        "p99_ms": _pct(lat, 0.99) * 1000,
+        "cpu_ms_per_1k": cpu * 1000 * 1000 / sent if sent else float("nan"),
+    }
+
+
+def _broker_thread():
+    ready = threading.Event()
+    box = []
+
+    def serve():
+        async def main():
+            server = await Broker().start("127.0.0.1", 0)
+            box.append(server.sockets[0].getsockname()[1])
+            ready.set()
+            while 1:
+                await asyncio.sleep(3600)
+
+        asyncio.run(main())
+
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait()
+    return box[0]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("modes", nargs="*", default=list(MODES), help="any of: " + ", ".join(MODES))
+    ap.add_argument("--host", help="external broker (default: in-process Broker)")
+    ap.add_argument("--port", type=int, default=1883)
+    ap.add_argument("--devices", type=int, default=10)
+    ap.add_argument("--rate", type=float, default=100, help="publishes/s per device, 0 for flat out")
+    ap.add_argument("--seconds", type=float, default=5)
+    ap.add_argument("--size", type=int, default=32, help="payload bytes")
+    a = ap.parse_args()
+    host, port = a.host, a.port
+    if host is None:
+        host, port = "127.0.0.1", _broker_thread()
+    print("%-12s %8s %8s %10s %8s %8s %12s" % ("mode", "sent", "recv", "msg/s", "p50 ms", "p99 ms", "cpu ms/1k"))
+    for m in a.modes:
+        r = run(m, host, port, a.devices, a.rate, a.seconds, a.size)
+        print(
+            "%-12s %8d %8d %10.0f %8.2f %8.2f %12.1f"
+            % (m, r["sent"], r["received"], r["msg_s"], r["p50_ms"], r["p99_ms"], r["cpu_ms_per_1k"])
+        )
+
+
+if __name__ == "__main__":
+    main()
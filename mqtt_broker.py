@@ -0,0 +1,301 @@
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+import struct
+
+
+# Minimal MQTT broker for testing MQTTClient without a public broker.
+# Speaks MQTT 3.1.1 and 5.0: CONNECT (with will, persistent sessions and
+# keepalive), SUBSCRIBE/UNSUBSCRIBE with + and # filters, PUBLISH at QoS
+# 0, 1 and 2, retained messages and inbound topic aliases. It keeps no
+# messages for offline sessions and does not retransmit unacknowledged
+# QoS 1/2 deliveries, so it is a stand-in for load and protocol tests,
+# not a production broker.
+#
+#   python mqtt_broker.py [port]
+#
+# or, from asyncio code, `await Broker().start(host, port)`.
+
+TOPIC_ALIAS_MAX = 16
+
+
+def _len(n):
+    out = bytearray()
+    while 1:
+        b = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+# Variable length integer at buf[i:], as (value, next index).
+def _varint(buf, i):
+    n = sh = 0
+    while 1:
+        b = buf[i]
+        i += 1
+        n |= (b & 0x7F) << sh
+        if not b & 0x80:
+            return n, i
+        sh += 7
+
+
+def _str(buf, i):
+    n = buf[i] << 8 | buf[i + 1]
+    return bytes(buf[i + 2 : i + 2 + n]), i + 2 + n
+
+
+def _pid(pid):
+    return struct.pack("!H", pid)
+
+
+# MQTT topic filter matching; wildcards at the first level do not match
+# topics starting with "$".
+def match(filt, topic):
+    if filt == topic:
+        return True
+    if topic[:1] == b"$" and filt[:1] in (b"+", b"#"):
+        return False
+    f = filt.split(b"/")
+    t = topic.split(b"/")
+    for i, p in enumerate(f):
+        if p == b"#":
+            return True
+        if i == len(t) or (p != b"+" and p != t[i]):
+            return False
+    return len(f) == len(t)
+
+
+class Session:
+    def __init__(self, cid):
+        self.cid = cid
+        self.writer = None
+        self.v5 = False
+        self.clean = True
+        self.keepalive = 0
+        self.will = None
+        # filter -> granted qos
+        self.subs = {}
+        self.pid = 0
+        # Inbound QoS 2 ids received but not yet released.
+        self.rx2 = set()
+        # Inbound topic aliases (MQTT 5).
+        self.aliases = {}
+
+
+class Broker:
+    def __init__(self):
+        self.sessions = {}
+        # topic -> (payload, qos)
+        self.retained = {}
+        self.server = None
+
+    async def start(self, host="127.0.0.1", port=1883):
+        self.server = await asyncio.start_server(self._client, host, port)
+        return self.server
+
+    async def _read(self, r, keepalive):
+        if keepalive:
+            # The spec allows one and a half keepalive periods of silence.
+            return await asyncio.wait_for(self._packet(r), keepalive * 1.5)
+        return await self._packet(r)
+
+    async def _packet(self, r):
+        op = (await r.readexactly(1))[0]
+        n = sh = 0
+        while 1:
+            b = (await r.readexactly(1))[0]
+            n |= (b & 0x7F) << sh
+            if not b & 0x80:
+                break
+            sh += 7
+        return op, (await r.readexactly(n) if n else b"")
+
+    async def _client(self, r, w):
+        s = None
+        try:
+            op, body = await self._packet(r)
+            if op != 0x10:
+                return
+            s = self._connect(body, w)
+            await w.drain()
+            while 1:
+                op, body = await self._read(r, s.keepalive)
+                if op == 0xE0:
+                    s.will = None
+                    break
+                self._handle(s, op, body)
+                await w.drain()
+        except (OSError, EOFError, ValueError, IndexError, asyncio.TimeoutError):
+            pass
+        finally:
+            if s is not None and s.writer is w:
+                self._drop(s)
+            w.close()
+
+    def _connect(self, body, w):
+        _, i = _str(body, 0)
+        level = body[i]
+        flags = body[i + 1]
+        keepalive = body[i + 2] << 8 | body[i + 3]
+        i += 4
+        v5 = level == 5
+        if v5:
+            n, i = _varint(body, i)
+            i += n
+        cid, i = _str(body, i)
+        will = None
+        if flags & 0x04:
+            if v5:
+                n, i = _varint(body, i)
+                i += n
+            topic, i = _str(body, i)
+            msg, i = _str(body, i)
+            will = (topic, msg, flags >> 3 & 3, bool(flags & 0x20))
+        clean = bool(flags & 0x02)
+        old = self.sessions.get(cid)
+        if old is not None and old.writer is not None:
+            # Session takeover: the newer connection wins.
+            old.writer.close()
+            old.writer = None
+        present = not clean and old is not None and not old.clean
+        s = old if present else Session(cid)
+        s.writer = w
+        s.v5 = v5
+        s.clean = clean
+        s.keepalive = keepalive
+        s.will = will
+        s.aliases = {}
+        self.sessions[cid] = s
+        if v5:
+            props = b"\x22" + _pid(TOPIC_ALIAS_MAX)
+            w.write(b"\x20" + _len(3 + len(props)) + bytes((present, 0, len(props))) + props)
+        else:
+            w.write(bytes((0x20, 2, present, 0)))
+        return s
+
+    def _drop(self, s):
+        s.writer = None
+        if s.will is not None:
+            self.route(*s.will)
+        if s.clean and self.sessions.get(s.cid) is s:
+            del self.sessions[s.cid]
+
+    def _handle(self, s, op, body):
+        w = s.writer
+        t = op & 0xF0
+        if t == 0x30:
+            qos = op >> 1 & 3
+            topic, i = _str(body, 0)
+            if qos:
+                pid = body[i] << 8 | body[i + 1]
+                i += 2
+            if s.v5:
+                n, i = _varint(body, i)
+                end = i + n
+                while i < end:
+                    if body[i] == 0x23:
+                        alias = body[i + 1] << 8 | body[i + 2]
+                        if topic:
+                            s.aliases[alias] = topic
+                        else:
+                            topic = s.aliases[alias]
+                        i += 3
+                    else:
+                        # Properties other than the alias are not forwarded.
+                        i = end
+                i = end
+            msg = body[i:]
+            if qos == 2:
+                w.write(b"\x50\x02" + _pid(pid))
+                if pid in s.rx2:
+                    return
+                s.rx2.add(pid)
+            elif qos == 1:
+                w.write(b"\x40\x02" + _pid(pid))
+            self.route(topic, msg, qos, op & 1)
+        elif op == 0x62:  # PUBREL
+            pid = body[0] << 8 | body[1]
+            s.rx2.discard(pid)
+            w.write(b"\x70\x02" + body[:2])
+        elif op == 0x50:  # PUBREC for a QoS 2 delivery
+            w.write(b"\x62\x02" + body[:2])
+        elif op == 0x82:  # SUBSCRIBE
+            i = 2
+            if s.v5:
+                n, i = _varint(body, i)
+                i += n
+            codes = bytearray()
+            new = []
+            while i < len(body):
+                f, i = _str(body, i)
+                q = min(body[i] & 3, 2)
+                i += 1
+                s.subs[f] = q
+                codes.append(q)
+                new.append((f, q))
+            ack = body[:2] + (b"\0" if s.v5 else b"") + codes
+            w.write(b"\x90" + _len(len(ack)) + ack)
+            for topic, (msg, rq) in self.retained.items():
+                for f, q in new:
+                    if match(f, topic):
+                        self._send(s, topic, msg, min(rq, q), 1)
+                        break
+        elif op == 0xA2:  # UNSUBSCRIBE
+            i = 2
+            if s.v5:
+                n, i = _varint(body, i)
+                i += n
+            k = 0
+            while i < len(body):
+                f, i = _str(body, i)
+                s.subs.pop(f, None)
+                k += 1
+            ack = body[:2] + (b"\0" + bytes(k) if s.v5 else b"")
+            w.write(b"\xb0" + _len(len(ack)) + ack)
+        elif op == 0xC0:
+            w.write(b"\xd0\0")
+
+    # Stores a retained message and delivers topic to every connected
+    # session with a matching filter, at the lower of the two QoS levels.
+    def route(self, topic, msg, qos, retain=False):
+        if retain:
+            if msg:
+                self.retained[topic] = (bytes(msg), qos)
+            else:
+                self.retained.pop(topic, None)
+        for s in self.sessions.values():
+            if s.writer is None:
+                continue
+            q = -1
+            for f, fq in s.subs.items():
+                if fq > q and match(f, topic):
+                    q = fq
+            if q >= 0:
+                self._send(s, topic, msg, min(qos, q), 0)
+
+    def _send(self, s, topic, msg, qos, retain):
+        body = _pid(len(topic)) + topic
+        if qos:
+            s.pid = s.pid % 65535 + 1
+            body += _pid(s.pid)
+        if s.v5:
+            body += b"\0"
+        s.writer.write(bytes((0x30 | qos << 1 | retain,)) + _len(len(body) + len(msg)) + body + msg)
+
+
+async def main(port=1883):
+    await Broker().start("0.0.0.0", port)
+    while 1:
+        await asyncio.sleep(3600)
+
+
+if __name__ == "__main__":
+    import sys
+
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1883))
@@ -17,11 +17,10 @@ client.set_callback(callback)          # set the callback if anything is read
 client.subscribe(topic_sub.encode())   # subscribe to a bunch of topics
 
 msg = 'this is a test'
-i = 0
+last = time.time()
 while True:
-    i+=1
-    if i %5 == 0:
+    if time.time() - last >= 5:
+        last = time.time()
         print('publishing')
         client.publish(topic_pub.encode(),msg.encode())
-    client.check_msg()
-    time.sleep(1)
\ No newline at end of file
+    client.poll(1000)                  # wait up to 1 s, waking early for messages
\ No newline at end of file
@@ -0,0 +1,410 @@
+import asyncio
+import socket
+import threading
+import time
+
+from mqtt_async import AsyncMQTTClient
+from mqtt_bench import Client
+from mqtt_broker import Broker
+
+
+# Protocol tests for MQTTClient and AsyncMQTTClient against the Broker in
+# mqtt_broker.py (CPython only). The blocking clients talk through
+# mqtt_bench's socket adapter, which keeps MicroPython's read semantics.
+#
+#   python mqtt_test.py      or      python -m pytest mqtt_test.py
+
+_broker = []
+
+
+# (Broker, port) of one broker thread shared by every test.
+def broker():
+    if not _broker:
+        ready = threading.Event()
+
+        def serve():
+            async def main():
+                b = Broker()
+                server = await b.start("127.0.0.1", 0)
+                _broker.append((b, server.sockets[0].getsockname()[1]))
+                ready.set()
+                while 1:
+                    await asyncio.sleep(3600)
+
+            asyncio.run(main())
+
+        threading.Thread(target=serve, daemon=True).start()
+        ready.wait()
+    return _broker[0]
+
+
+def client(cid, **kw):
+    return Client(cid, "127.0.0.1", broker()[1], **kw)
+
+
+def subscriber(cid, topic, qos=0, **kw):
+    got = []
+    c = client(cid, **kw)
+    c.set_callback(lambda t, m: got.append((bytes(t), bytes(m))))
+    c.connect()
+    c.subscribe(topic, qos)
+    return c, got
+
+
+# Polls c until done() or timeout_ms.
+def until(c, done, timeout_ms=2000):
+    t0 = time.monotonic()
+    while not done() and (time.monotonic() - t0) * 1000 < timeout_ms:
+        c.poll(20)
+    return done()
+
+
+# A one-connection-at-a-time TCP server running script(conn, n) for the
+# n-th connection, for cases the broker does not produce on its own.
+def scripted(script):
+    srv = socket.socket()
+    srv.bind(("127.0.0.1", 0))
+    srv.listen(2)
+
+    def serve():
+        for n in range(2):
+            c, _ = srv.accept()
+            try:
+                script(c, n)
+            finally:
+                c.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return srv.getsockname()[1]
+
+
+def test_qos1_qos2_round_trip():
+    s, got = subscriber(b"rt-sub", b"rt/#", 2)
+    p = client(b"rt-pub", max_inflight=4)
+    p.connect()
+    for i in range(5):
+        p.publish(b"rt/1", b"one%d" % i, qos=1)
+        p.publish(b"rt/2", b"two%d" % i, qos=2)
+    p.wait_inflight()
+    assert until(s, lambda: len(got) == 10)
+    assert [m for t, m in got if t == b"rt/1"] == [b"one%d" % i for i in range(5)]
+    assert [m for t, m in got if t == b"rt/2"] == [b"two%d" % i for i in range(5)]
+    assert until(s, lambda: not s._rx_pids)  # every id released by PUBREL
+    s.poll(100)
+    assert len(got) == 10  # QoS 2 delivered exactly once
+    p.disconnect()
+    s.disconnect()
+
+
+def test_reconnect_replays_subscriptions_and_queue():
+    b, _ = broker()
+    s, got = subscriber(b"rc-sub", b"rc/out")
+    c = client(b"rc-dev", keepalive=10)
+    mine = []
+    c.set_callback(lambda t, m: mine.append(bytes(m)))
+    c.set_reconnect(min_ms=0)
+    c.connect(False)
+    c.subscribe(b"rc/in", 1)
+    # Link and session both gone: the subscription has to be replayed.
+    b.sessions.pop(b"rc-dev", None)
+    c._lost()
+    c.publish(b"rc/out", b"queued", qos=1)
+    assert c.sock is None and len(c._offline) == 1
+    c.poll(0)
+    assert c.sock is not None and not c._offline
+    c.wait_inflight()
+    assert until(s, lambda: got == [(b"rc/out", b"queued")])
+    p = client(b"rc-pub")
+    p.connect()
+    p.publish(b"rc/in", b"after", qos=1)
+    p.wait_inflight()
+    assert until(c, lambda: mine == [b"after"])
+    for x in (p, c, s):
+        x.disconnect()
+
+
+def test_link_lost_during_replay():
+    class Flaky(Client):
+        fail = 0
+
+        def _out(self, data):
+            if self.fail and data[0] == 0x82:
+                self.fail -= 1
+                raise ConnectionResetError
+            super()._out(data)
+
+    b, _ = broker()
+    got = []
+    c = Flaky(b"lr-dev", "127.0.0.1", broker()[1])
+    c.set_callback(lambda t, m: got.append(bytes(m)))
+    c.set_reconnect(min_ms=0)
+    c.connect(False)
+    c.subscribe(b"lr/t")
+    # New session, and the link goes again as the subscription is replayed.
+    b.sessions.pop(b"lr-dev", None)
+    c._lost()
+    c.fail = 1
+    assert c.check_msg() is None and c.sock is None
+    assert until(c, lambda: c.sock is not None and not c._resub)
+    p = client(b"lr-pub")
+    p.connect()
+    p.publish(b"lr/t", b"back")
+    assert until(c, lambda: got == [b"back"])
+    p.disconnect()
+    c.disconnect()
+
+
+def test_subscribe_survives_reconnect():
+    subs = []
+
+    def script(conn, n):
+        conn.recv(100)
+        conn.sendall(bytes((0x20, 2, n, 0)))
+        d = conn.recv(100)
+        subs.append(d)
+        if n:
+            conn.sendall(b"\x90\x03" + d[2:4] + b"\x01")
+            time.sleep(0.5)
+
+    c = Client(b"sr", "127.0.0.1", scripted(script))
+    c.set_callback(lambda t, m: None)
+    c.set_reconnect(min_ms=0)
+    c.connect()
+    c.subscribe(b"sr/t", 1)  # first link drops before SUBACK
+    assert len(subs) == 2 and subs[0][4:] == subs[1][4:]
+    assert not c._subacks and not c._moved
+
+
+def test_new_session_forgets_qos2_ids():
+    got = []
+    pub = b"\x34\x08\0\x01t\0\x07"
+
+    def script(conn, n):
+        conn.recv(100)
+        conn.sendall(b"\x20\x02\0\0" + pub + (b"new" if n else b"old"))
+        time.sleep(0.3)
+
+    c = Client(b"q2", "127.0.0.1", scripted(script))
+    c.set_callback(lambda t, m: got.append(bytes(m)))
+    c.connect()
+    assert until(c, lambda: got == [b"old"])
+    c.sock.close()
+    c.connect()
+    assert until(c, lambda: got == [b"old", b"new"])
+
+
+def test_v5_server_keepalive_and_no_timeout_resend():
+    seen = []
+
+    def script(conn, n):
+        conn.recv(100)
+        # CONNACK with Server Keep Alive = 1 s.
+        conn.sendall(b"\x20\x06\0\0\x03\x13\0\x01")
+        conn.settimeout(2)
+        try:
+            while 1:
+                h = conn.recv(2)
+                if len(h) < 2:
+                    break
+                if h[1]:
+                    conn.recv(h[1])
+                seen.append(h[0])
+                if h[0] == 0xC0:
+                    conn.sendall(b"\xd0\0")
+        except OSError:
+            pass
+
+    c = Client(b"ka5", "127.0.0.1", scripted(script), keepalive=60, retry_ms=100, protocol=5)
+    c.connect()
+    assert c.keepalive == 1
+    c.publish(b"t", b"never acked", qos=1)
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < 1.2:
+        c.poll(50)
+    assert seen.count(0x32) == 1  # no resend on timeout
+    assert 0xC0 in seen  # pings at the broker's interval
+
+
+def test_topic_aliases():
+    s, got = subscriber(b"al-sub", b"al/#")
+    p = client(b"al-pub", protocol=5)
+    p.connect()
+    assert p.topic_alias_max == 16
+    for i in range(3):
+        p.publish(b"al/a", b"a%d" % i)
+    assert p._aliases == {b"al/a": 1}
+    p.publish(b"al/q", b"q0", qos=1)
+    p.publish(b"al/q", b"q1", qos=1)
+    p.wait_inflight()
+    assert b"al/q" not in p._aliases  # never on QoS 1/2
+    # New connection: aliases start again, b gets alias 1.
+    p.sock.close()
+    p.connect()
+    assert not p._aliases
+    for i in range(3):
+        p.publish(b"al/b", b"b%d" % i)
+    assert p._aliases == {b"al/b": 1}
+    want = [(b"al/a", b"a%d" % i) for i in range(3)]
+    want += [(b"al/q", b"q0"), (b"al/q", b"q1")]
+    want += [(b"al/b", b"b%d" % i) for i in range(3)]
+    assert until(s, lambda: len(got) == len(want))
+    assert got == want
+    p.disconnect()
+    s.disconnect()
+
+
+def test_chunked_receive():
+    chunks = []
+    s, got = subscriber(b"ch-sub", b"ch/#", 1, rbuf_size=64)
+    s.set_chunk_callback(lambda t, c, off, total: chunks.append((bytes(t), bytes(c), off, total)))
+    big = bytes(range(256)) * 4
+    p = client(b"ch-pub", wbuf_size=64)
+    p.connect()
+    p.publish(b"ch/big", big, qos=1)
+    p.publish(b"ch/small", b"hi")
+    p.wait_inflight()
+    assert until(s, lambda: got and chunks and chunks[-1][2] + len(chunks[-1][1]) == len(big))
+    assert len(chunks) > 1
+    assert b"".join(c for _, c, _, _ in chunks) == big
+    assert all(t == b"ch/big" and total == len(big) for t, _, _, total in chunks)
+    assert got == [(b"ch/small", b"hi")]
+    assert len(s._rbuf) == 64  # streamed, not buffered
+    p.disconnect()
+    s.disconnect()
+
+
+def test_chunked_receive_v5_split_properties():
+    big = bytes(range(200)) * 3
+    body = b"\0\x03big\x02\x01\x01" + big
+    pkt = b"\x30" + bytes((len(body) & 0x7F | 0x80, len(body) >> 7)) + body
+
+    def script(conn, n):
+        conn.recv(100)
+        conn.sendall(b"\x20\x03\0\0\0")
+        # Stop right where the property length starts.
+        conn.sendall(pkt[:8])
+        time.sleep(0.2)
+        conn.sendall(pkt[8:])
+        time.sleep(0.3)
+
+    chunks = []
+    c = Client(b"v5", "127.0.0.1", scripted(script), rbuf_size=64, protocol=5)
+    c.set_chunk_callback(lambda t, ch, off, total: chunks.append((bytes(ch), off, total)))
+    c.connect()
+    assert until(c, lambda: chunks and chunks[-1][1] + len(chunks[-1][0]) == len(big))
+    assert b"".join(ch for ch, _, _ in chunks) == big
+    assert all(total == len(big) for _, _, total in chunks)
+
+
+def test_last_value_cache():
+    c = client(b"lvc-sub")
+    c.set_cache()
+    c.connect()
+    c.subscribe("lvc/#")
+    p = client(b"lvc-pub")
+    p.connect()
+    p.publish("lvc/t", "hello")
+    p.publish(b"lvc/u", b"a")
+    p.publish(b"lvc/u", b"b")
+    assert until(c, lambda: c.seq == 3)
+    assert c.get_latest("lvc/t") == c.get_latest(b"lvc/t") == (1, b"hello")
+    assert c.get_latest("lvc/u", 2) == (3, b"b")
+    assert c.get_latest("lvc/u", 3) is None
+    assert c.changed_since(1) == [b"lvc/u"]
+    p.disconnect()
+    c.disconnect()
+
+
+def test_idle_client_keeps_link():
+    s, got = subscriber(b"ka-sub", b"ka/t", keepalive=1)
+    # Well past the broker's 1.5 x keepalive without traffic of our own.
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < 2.5:
+        s.wait_msg()
+    p = client(b"ka-pub")
+    p.connect()
+    p.publish(b"ka/t", b"still here")
+    assert until(s, lambda: got == [(b"ka/t", b"still here")])
+    p.disconnect()
+    s.disconnect()
+
+
+def aclient(cid, **kw):
+    return AsyncMQTTClient(cid, "127.0.0.1", broker()[1], **kw)
+
+
+# The next n messages from an async iterator, or fewer if it ends.
+async def take(it, n, timeout=2):
+    async def run():
+        out = []
+        async for m in it:
+            out.append(m)
+            if len(out) == n:
+                break
+        return out
+
+    return await asyncio.wait_for(run(), timeout)
+
+
+def test_async_client():
+    async def main():
+        s = aclient(b"as-sub")
+        await s.connect()
+        await s.subscribe(b"as/q")
+
+        def bad(t, m):
+            raise ValueError(m)
+
+        # A handler that raises neither stops the reader nor skips the ack.
+        await s.subscribe(b"as/bad", 1, bad)
+        p = aclient(b"as-pub", max_inflight=4)
+        await p.connect()
+        await p.publish(b"as/bad", b"boom", qos=1)
+        for i in range(3):
+            await p.publish(b"as/q", b"m%d" % i, qos=1)
+        await asyncio.wait_for(p.wait_inflight(), 2)
+        assert await take(s, 3) == [(b"as/q", b"m%d" % i) for i in range(3)]
+        await s.disconnect()
+        assert await take(s, 1) == []
+        await p.disconnect()
+
+    asyncio.run(main())
+    try:
+        aclient(b"as-x").set_reconnect()
+        assert False
+    except NotImplementedError:
+        pass
+
+
+def test_async_handles():
+    async def main():
+        c = aclient(b"ah-sub")
+        await c.connect()
+        a = c.handle()
+        b = c.handle()
+        await a.subscribe(b"ah/t")
+        await b.subscribe(b"ah/t")
+        await b.subscribe(b"ah/b")
+        p = aclient(b"ah-pub")
+        await p.connect()
+        await p.publish(b"ah/t", b"both")
+        await p.publish(b"ah/b", b"b only")
+        assert await take(a, 1) == [(b"ah/t", b"both")]
+        assert await take(b, 2) == [(b"ah/t", b"both"), (b"ah/b", b"b only")]
+        # b's close leaves a's subscription to the shared filter in place.
+        await b.close()
+        assert await take(b, 1) == []
+        await p.publish(b"ah/t", b"again")
+        assert await take(a, 1) == [(b"ah/t", b"again")]
+        await p.disconnect()
+        await c.disconnect()
+        assert await take(a, 1) == []
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    for name, f in list(globals().items()):
+        if name.startswith("test_"):
+            f()
+            print("ok", name)